@@ -1,16 +1,28 @@
 import os
+import atexit
+import signal
+import re
 import logging
+import queue
 import asyncio
 import aiosqlite
-import traceback
-from datetime import datetime, timedelta
-from aiogram import Bot, Dispatcher, types
+import sqlite3
+import time
+from contextlib import asynccontextmanager, closing, suppress
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+from pathlib import Path
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, flags, types
+from aiogram.dispatcher.flags import get_flag
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import FSInputFile, InlineKeyboardButton
+from aiogram.types import BufferedInputFile, FSInputFile, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from aiogram.exceptions import TelegramAPIError
+from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 from dotenv import load_dotenv
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 import csv
@@ -20,40 +32,57 @@ import aiogram
 if aiogram.__version__ == "3.11.0":
     raise ImportError(f"Ожидается другая версия aiogram, установлена версия {aiogram.__version__}")
 
-# Настройка логирования
-logging.basicConfig(
-    filename="memo_bot.log",
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s"
-)
-
+# Настройка логирования: обработчики только кладут запись в очередь,
+# запись в файл с ротацией делает QueueListener в отдельном потоке
 logger = logging.getLogger()
+logger.setLevel(logging.INFO)
 
-# Ротация логов
-from logging.handlers import RotatingFileHandler
-handler = RotatingFileHandler("memo_bot.log", maxBytes=10*1024*1024, backupCount=5)
-handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
-logger.addHandler(handler)
+file_handler = RotatingFileHandler("memo_bot.log", maxBytes=10*1024*1024, backupCount=5, encoding="utf-8")
+file_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+log_records = queue.SimpleQueue()
+logger.addHandler(QueueHandler(log_records))
+log_listener = QueueListener(log_records, file_handler, respect_handler_level=True)
+log_listener.start()
+# Дописываем оставшиеся записи при выходе из процесса
+atexit.register(log_listener.stop)
 
 # Загрузка конфигурации
 load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 try:
-    ADMIN_IDS = [int(x) for x in os.getenv("ADMIN_IDS", "").split(",")]
+    ADMIN_IDS = frozenset(int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip())
 except ValueError:
     logger.error("Ошибка: ADMIN_IDS содержит нечисловые значения")
     raise ValueError("ADMIN_IDS содержит нечисловые значения")
 
 DB_PATH = "database.db"
 
+# Схема базы читается один раз при загрузке модуля
+try:
+    SCHEMA_SQL = Path("schema.sql").read_text(encoding="utf-8")
+except FileNotFoundError:
+    logger.error("Ошибка: файл schema.sql не найден")
+    raise FileNotFoundError("Файл schema.sql не найден")
+
 if not BOT_TOKEN or not ADMIN_IDS:
     logger.error("Ошибка: BOT_TOKEN или ADMIN_IDS не заданы в .env")
     raise ValueError("BOT_TOKEN или ADMIN_IDS не заданы в .env")
 
+# Webhook включается, если задан WEBHOOK_URL (внешний адрес бота); иначе — long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+
+# Список для рассылки администраторам пачками
+ADMIN_IDS_LIST = tuple(ADMIN_IDS)
+
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
-scheduler = AsyncIOScheduler()
+# Пропущенные запуски задач схлопываются в один, задача не запускается параллельно сама с собой
+scheduler = AsyncIOScheduler(job_defaults={"coalesce": True, "max_instances": 1, "misfire_grace_time": 60})
 
 # Определение состояний FSM
 class Form(StatesGroup):
@@ -72,7 +101,7 @@ class Form(StatesGroup):
     support_message = State()
     profit_user = State()
 
-# Словарь сообщений
+# Словарь сообщений, шаблоны с параметрами — функции
 MESSAGES = {
     "error": "Произошла ошибка. Пожалуйста, попробуйте снова.",
     "no_access": "У вас нет доступа к этой команде.",
@@ -80,69 +109,172 @@ MESSAGES = {
     "invalid_format": "Неверный формат ввода. Пожалуйста, следуйте примеру.",
     "no_squads": "Нет созданных сквадов.",
     "no_escorts": "Нет зарегистрированных сопровождающих.",
-    "squad_delete": "Сквад '{squad_name}' успешно расформирован.",
-    "order_added": "Заказ #{order_id} добавлен!\nКлиент: {customer}\nСумма: {amount:.2f} руб.\nОписание: {description}",
+    "squad_delete": lambda squad_name: f"Сквад '{squad_name}' успешно расформирован.",
+    "order_added": lambda order_id, customer, amount, description: f"Заказ #{order_id} добавлен!\nКлиент: {customer}\nСумма: {amount:.2f} руб.\nОписание: {description}",
     "user_banned": "Вы заблокированы навсегда.",
-    "user_restricted": "Ваши действия ограничены до {date}",
-    "user_unbanned": "Бан снят с пользователя {username}",
-    "user_unrestricted": "Ограничение снято с пользователя {username}",
-    "balance_zeroed": "Баланс пользователя ID {user_id} обнулён.",
+    "user_restricted": lambda date: f"Ваши действия ограничены до {date}",
+    "user_unbanned": lambda username: f"Бан снят с пользователя {username}",
+    "user_unrestricted": lambda username: f"Ограничение снято с пользователя {username}",
+    "balance_zeroed": lambda user_id: f"Баланс пользователя ID {user_id} обнулён.",
     "no_data_to_export": "Нет данных для экспорта.",
-    "export_success": "Данные экспортированы в {filename}",
+    "export_success": lambda filename: f"Данные экспортированы в {filename}",
     "support_request": "Введите ваш запрос в поддержку.",
     "support_sent": "Запрос отправлен в поддержку.",
     "no_orders": "Нет доступных заказов.",
     "no_active_orders": "У вас нет активных заказов.",
 }
 
+# Общее соединение с базой данных, открывается в init_db
+db: aiosqlite.Connection | None = None
+# Размер кэша подготовленных запросов sqlite3 на соединении
+DB_STATEMENT_CACHE = 256
+# Настройки соединения, применяются одним скриптом при открытии
+DB_PRAGMAS = """
+    PRAGMA synchronous = NORMAL;
+    PRAGMA mmap_size = 268435456;
+    PRAGMA cache_size = -65536;
+    PRAGMA temp_store = MEMORY;
+    PRAGMA busy_timeout = 30000;
+    PRAGMA foreign_keys = ON;
+"""
+
 # Инициализация базы данных
 async def init_db():
+    global db
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            await conn.execute("PRAGMA foreign_keys = ON")
-            with open("schema.sql", "r", encoding="utf-8") as f:
-                sql_script = f.read()
-            await conn.executescript(sql_script)
-            await conn.commit()
-            logger.info("База данных успешно инициализирована из schema.sql")
+        # isolation_level=None: транзакциями управляем сами (BEGIN IMMEDIATE в db_write)
+        db = await aiosqlite.connect(DB_PATH, isolation_level=None, cached_statements=DB_STATEMENT_CACHE)
+        cursor = await db.execute("PRAGMA journal_mode = WAL")
+        journal_mode = (await cursor.fetchone())[0]
+        if journal_mode != "wal":
+            logger.warning("Не удалось включить WAL, режим журнала: %s", journal_mode)
+        await db.executescript(DB_PRAGMAS)
+        await db.executescript(SCHEMA_SQL)
+        logger.info("База данных успешно инициализирована из schema.sql")
     except aiosqlite.Error as e:
-        logger.error(f"Ошибка инициализации базы данных: {e}\n{traceback.format_exc()}")
+        logger.error("Ошибка инициализации базы данных: %s", e, exc_info=True)
         raise
-    except FileNotFoundError:
-        logger.error("Ошибка: файл schema.sql не найден")
-        raise FileNotFoundError("Файл schema.sql не найден")
+
+# Запись в базу: изменения выполняются под общей блокировкой одной явной транзакцией
+# BEGIN IMMEDIATE (блокировка на запись берётся сразу), COMMIT при успехе и ROLLBACK при ошибке
+db_lock = asyncio.Lock()
+
+@asynccontextmanager
+async def db_write():
+    async with db_lock:
+        try:
+            await db.execute("BEGIN IMMEDIATE")
+            yield db
+            await db.execute("COMMIT")
+        except BaseException:
+            # Транзакция могла остаться открытой (ошибка COMMIT, отмена задачи) — иначе все
+            # следующие db_write() упадут с "cannot start a transaction within a transaction".
+            # ROLLBACK шлём без проверки db.in_transaction: запросы aiosqlite выполняются по очереди,
+            # и BEGIN, отправленный до отмены задачи, может ещё стоять в очереди
+            with suppress(sqlite3.OperationalError):
+                await db.execute("ROLLBACK")
+            raise
+
+# Периодическое обновление статистики планировщика запросов SQLite.
+# ANALYZE пишет в sqlite_stat1, поэтому тоже под db_lock
+async def optimize_db():
+    try:
+        async with db_lock:
+            await db.execute("PRAGMA optimize")
+    except aiosqlite.Error as e:
+        logger.error("Ошибка PRAGMA optimize: %s", e)
+
+# Периодический checkpoint: переносит WAL в базу и обрезает файл -wal до нуля.
+# Под db_lock, чтобы не попасть внутрь открытой транзакции записи
+async def checkpoint_db():
+    try:
+        async with db_lock:
+            await db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    except aiosqlite.Error as e:
+        logger.error("Ошибка PRAGMA wal_checkpoint: %s", e)
+
+# Закрытие соединения с базой данных
+async def close_db():
+    if db is not None:
+        await db.close()
+
+# Статус доступа всех сопровождающих: telegram_id -> (is_banned, ban_until, restrict_until).
+# Загружается при старте, дальше его обновляют обработчики, меняющие эти поля в escorts
+_access_status: dict[int, tuple] = {}
+
+async def load_access_status():
+    rows = await db.execute_fetchall("SELECT telegram_id, is_banned, ban_until, restrict_until FROM escorts")
+    _access_status.clear()
+    _access_status.update((telegram_id, tuple(status)) for telegram_id, *status in rows)
 
 # Проверка доступа
 async def check_access(message: types.Message) -> bool:
-    user_id = message.from_user.id
-    async with aiosqlite.connect(DB_PATH) as conn:
-        cursor = await conn.execute(
-            "SELECT is_banned, ban_until, restrict_until FROM escorts WHERE telegram_id = ?",
-            (user_id,)
-        )
-        user = await cursor.fetchone()
-        if not user:
-            await message.answer("Вы не зарегистрированы. Обратитесь к администратору.")
+    user = _access_status.get(message.from_user.id)
+    if not user:
+        await message.answer("Вы не зарегистрированы. Обратитесь к администратору.")
+        return False
+    is_banned, ban_until, restrict_until = user
+    now = time.time()
+    if is_banned:
+        if ban_until and ban_until > now:
+            formatted_date = datetime.fromtimestamp(ban_until).strftime("%d.%m.%Y")
+            await message.answer(f"Вы заблокированы до {formatted_date}.")
             return False
-        is_banned, ban_until, restrict_until = user
-        if is_banned:
-            if ban_until and datetime.fromisoformat(ban_until) > datetime.now():
-                formatted_date = datetime.fromisoformat(ban_until).strftime("%d.%m.%Y")
-                await message.answer(f"Вы заблокированы до {formatted_date}.")
-                return False
-            elif not ban_until:
-                await message.answer(MESSAGES["user_banned"])
-                return False
-        if restrict_until and datetime.fromisoformat(restrict_until) > datetime.now():
-            formatted_date = datetime.fromisoformat(restrict_until).strftime("%d.%m.%Y")
-            await message.answer(f"Ваши действия ограничены до {formatted_date}.")
+        elif not ban_until:
+            await message.answer(MESSAGES["user_banned"])
             return False
-        return True
+    if restrict_until and restrict_until > now:
+        formatted_date = datetime.fromtimestamp(restrict_until).strftime("%d.%m.%Y")
+        await message.answer(f"Ваши действия ограничены до {formatted_date}.")
+        return False
+    return True
+
+# Дата из ISO-строки в формате ДД.ММ.ГГГГ без разбора через datetime
+def format_date(iso: str) -> str:
+    if len(iso) < 10:
+        return datetime.fromisoformat(iso).strftime("%d.%m.%Y")
+    return f"{iso[8:10]}.{iso[5:7]}.{iso[0:4]}"
+
+# Telegram ID из текста сообщения (None, если это не число разумной длины)
+TELEGRAM_ID_MAX_DIGITS = 16
+
+def parse_telegram_id(text: str) -> int | None:
+    text = text.strip()
+    if not (len(text) <= TELEGRAM_ID_MAX_DIGITS and text.isascii() and text.isdigit()):
+        return None
+    return int(text)
+
+# Разделитель полей в вводе администратора: запятая с любыми пробелами вокруг
+_COMMA_RE = re.compile(r"\s*,\s*")
+
+# Максимальный срок бана/ограничения в днях: дальше дата не помещается в datetime
+MAX_PENALTY_DAYS = 3650
+
+# Начало 30-дневного окна отчетов: дата в UTC, как у CURRENT_TIMESTAMP в базе
+def report_start_date() -> str:
+    return (datetime.now(timezone.utc) - timedelta(days=30)).strftime("%Y-%m-%d")
 
 # Проверка, является ли пользователь администратором
 def is_admin(user_id: int) -> bool:
     return user_id in ADMIN_IDS
 
+# Тексты кнопок меню
+SQUADS_BUTTONS = ("Добавить сквад", "Список сквадов", "Расформировать сквад", "Назад")
+ESCORTS_BUTTONS = ("Добавить сопровождающего", "Удалить сопровождающего", "Пользователи", "Назад")
+BAN_RESTRICT_BUTTONS = ("Бан навсегда", "Бан на время", "Ограничить", "Снять бан", "Снять ограничение", "Назад")
+BALANCES_BUTTONS = ("Баланс сопровождающих", "Начислить", "Обнулить баланс", "Назад")
+USER_MENU_BUTTONS = ("Отчеты/справка",)
+ADMIN_MENU_BUTTONS = ("Отчеты/справка", "Админ-панель")
+REPORTS_BUTTONS = ("Отчет за месяц", "Экспорт данных", "Журнал действий", "Доход пользователей", "Назад")
+
+# Клавиатура из списка кнопок, callback_data строится из текста кнопки
+def build_keyboard(buttons, width: int = 2):
+    builder = InlineKeyboardBuilder()
+    for button in buttons:
+        builder.add(InlineKeyboardButton(text=button, callback_data=button.lower().replace(" ", "_")))
+    builder.adjust(width)
+    return builder.as_markup(resize_keyboard=True)
+
 # Главная админ-клавиатура
 def get_admin_keyboard():
     builder = InlineKeyboardBuilder()
@@ -166,1206 +298,1186 @@ def get_orders_keyboard():
 
 # Клавиатура для группы "Сквады"
 def get_squads_keyboard():
-    builder = InlineKeyboardBuilder()
-    buttons = ["Добавить сквад", "Список сквадов", "Расформировать сквад", "Назад"]
-    for button in buttons:
-        builder.add(InlineKeyboardButton(text=button, callback_data=button.lower().replace(" ", "_")))
-    builder.adjust(2)
-    return builder.as_markup(resize_keyboard=True)
+    return build_keyboard(SQUADS_BUTTONS)
 
 # Клавиатура для группы "Сопровождающие"
 def get_escorts_keyboard():
-    builder = InlineKeyboardBuilder()
-    buttons = ["Добавить сопровождающего", "Удалить сопровождающего", "Пользователи", "Назад"]
-    for button in buttons:
-        builder.add(InlineKeyboardButton(text=button, callback_data=button.lower().replace(" ", "_")))
-    builder.adjust(2)
-    return builder.as_markup(resize_keyboard=True)
+    return build_keyboard(ESCORTS_BUTTONS)
 
 # Клавиатура для группы "Бан/ограничение"
 def get_ban_restrict_keyboard():
-    builder = InlineKeyboardBuilder()
-    buttons = ["Бан навсегда", "Бан на время", "Ограничить", "Снять бан", "Снять ограничение", "Назад"]
-    for button in buttons:
-        builder.add(InlineKeyboardButton(text=button, callback_data=button.lower().replace(" ", "_")))
-    builder.adjust(2)
-    return builder.as_markup(resize_keyboard=True)
+    return build_keyboard(BAN_RESTRICT_BUTTONS)
 
 # Клавиатура для группы "Баланс"
 def get_balances_keyboard():
-    builder = InlineKeyboardBuilder()
-    buttons = ["Баланс сопровождающих", "Начислить", "Обнулить баланс", "Назад"]
-    for button in buttons:
-        builder.add(InlineKeyboardButton(text=button, callback_data=button.lower().replace(" ", "_")))
-    builder.adjust(2)
-    return builder.as_markup(resize_keyboard=True)
+    return build_keyboard(BALANCES_BUTTONS)
 
 # Клавиатура для группы "Отчеты/справка"
 def get_reports_keyboard():
-    builder = InlineKeyboardBuilder()
-    buttons = ["Отчет за месяц", "Экспорт данных", "Журнал действий", "Доход пользователей", "Назад"]
-    for button in buttons:
-        builder.add(InlineKeyboardButton(text=button, callback_data=button.lower().replace(" ", "_")))
-    builder.adjust(2)
-    return builder.as_markup(resize_keyboard=True)
+    return build_keyboard(REPORTS_BUTTONS)
 
 # Клавиатура отмены
-def get_cancel_keyboard(admin=False):
+def get_cancel_keyboard():
     builder = InlineKeyboardBuilder()
     builder.add(InlineKeyboardButton(text="Отмена", callback_data="cancel"))
     return builder.as_markup(resize_keyboard=True)
 
+# Клавиатура главного меню для роли (администратор или пользователь)
+def build_menu_keyboard(admin: bool):
+    return build_keyboard(ADMIN_MENU_BUTTONS if admin else USER_MENU_BUTTONS, width=1)
+
+# Статичные клавиатуры строятся один раз при загрузке модуля
+ORDERS_KB = get_orders_keyboard()
+BALANCES_KB = get_balances_keyboard()
+BAN_RESTRICT_KB = get_ban_restrict_keyboard()
+CANCEL_KB = get_cancel_keyboard()
+ADMIN_KB = get_admin_keyboard()
+SQUADS_KB = get_squads_keyboard()
+ESCORTS_KB = get_escorts_keyboard()
+REPORTS_KB = get_reports_keyboard()
+MENU_KB = {True: build_menu_keyboard(True), False: build_menu_keyboard(False)}
+
 # Клавиатура главного меню
 def get_menu_keyboard(user_id: int):
-    builder = InlineKeyboardBuilder()
-    buttons = ["Отчеты/справка"]
-    if is_admin(user_id):
-        buttons.append("Админ-панель")
-    for button in buttons:
-        builder.add(InlineKeyboardButton(text=button, callback_data=button.lower().replace(" ", "_")))
-    builder.adjust(1)
-    return builder.as_markup(resize_keyboard=True)
+    return MENU_KB[is_admin(user_id)]
+
+# Ограничитель частоты (token bucket): не больше rate вызовов за period секунд
+class RateLimiter:
+    def __init__(self, rate: int, period: float = 1.0):
+        self.rate = rate
+        self.period = period
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.period)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) * self.period / self.rate)
+
+    async def __aexit__(self, *exc):
+        return False
+
+# Глобальный лимит Telegram на рассылку — около 30 сообщений в секунду, берём 29 с запасом
+send_limiter = RateLimiter(29)
+# Не больше SEND_CONCURRENCY запросов к Telegram одновременно, чтобы медленные ответы не копились
+SEND_CONCURRENCY = 25
+send_semaphore = asyncio.Semaphore(SEND_CONCURRENCY)
+
+# Безопасная отправка сообщений: при RetryAfter ждём и повторяем, не больше SEND_ATTEMPTS попыток
+SEND_ATTEMPTS = 3
 
-# Безопасная отправка сообщений
 async def safe_send_message(chat_id, text, **kwargs):
-    try:
-        await bot.send_message(chat_id, text, **kwargs)
-    except TelegramAPIError as e:
-        if e.response.get('error_code') == 429:
-            parameters = e.response.get('parameters', {})
-            retry_after = parameters.get('retry_after', 0)
-            if retry_after > 0:
-                logger.warning(f"Rate limit: {retry_after} секунд")
-                await asyncio.sleep(retry_after)
+    for attempt in range(1, SEND_ATTEMPTS + 1):
+        try:
+            async with send_semaphore, send_limiter:
                 await bot.send_message(chat_id, text, **kwargs)
-            else:
-                logger.error(f"Ошибка отправки сообщения для chat_id {chat_id}: {e}")
-        else:
-            logger.error(f"Ошибка отправки сообщения для chat_id {chat_id}: {e}")
-    return True
+            return True
+        except TelegramRetryAfter as e:
+            logger.warning("Rate limit: %s секунд", e.retry_after)
+            if attempt < SEND_ATTEMPTS:
+                await asyncio.sleep(e.retry_after)
+        except TelegramAPIError as e:
+            logger.error("Ошибка отправки сообщения для chat_id %s: %s", chat_id, e)
+            return False
+    logger.error("Сообщение для chat_id %s не отправлено после %s попыток", chat_id, SEND_ATTEMPTS)
+    return False
+
+# Отправка длинного ответа частями до MESSAGE_CHUNK_LIMIT символов, клавиатура — у последней части
+MESSAGE_CHUNK_LIMIT = 3900
+
+async def answer_chunked(message: types.Message, parts: list[str], reply_markup=None, sep: str = "\n"):
+    chunks, current, length = [], [], 0
+    pieces = (part[i:i + MESSAGE_CHUNK_LIMIT] for part in parts for i in range(0, max(len(part), 1), MESSAGE_CHUNK_LIMIT))
+    for part in pieces:
+        if current and length + len(sep) + len(part) > MESSAGE_CHUNK_LIMIT:
+            chunks.append(sep.join(current))
+            current, length = [], 0
+        length += len(part) + (len(sep) if current else 0)
+        current.append(part)
+    chunks.append(sep.join(current))
+    for chunk in chunks[:-1]:
+        await message.answer(chunk)
+    await message.answer(chunks[-1], reply_markup=reply_markup)
+
+# Очередь записей журнала действий, пишется в базу пачками в log_writer
+log_queue: asyncio.Queue = asyncio.Queue()
+LOG_BATCH_SIZE = 256
+LOG_FLUSH_INTERVAL = 1
 
 # Логирование действий
-async def log_action(action_type: str, user_id: int, order_id: str | None, description: str):
-    try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            await conn.execute(
-                "INSERT INTO action_log (action_type, user_id, order_id, description) VALUES (?, ?, ?, ?)",
-                (action_type, user_id, order_id, description)
-            )
-            await conn.commit()
-            logger.info(f"Действие '{action_type}' для user_id {user_id}: {description}")
-    except aiosqlite.Error as e:
-        logger.error(f"Ошибка логирования действия '{action_type}' для user_id {user_id}: {e}\n{traceback.format_exc()}")
+def log_action(action_type: str, user_id: int, order_id: str | None, description: str):
+    action_date = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    log_queue.put_nowait((action_type, user_id, order_id, description, action_date))
+    logger.info("Действие '%s' для user_id %s: %s", action_type, user_id, description)
+
+# Фоновая запись журнала действий: пачка до LOG_BATCH_SIZE записей или LOG_FLUSH_INTERVAL секунд, одна транзакция
+async def log_writer():
+    while True:
+        batch = [await log_queue.get()]
+        deadline = asyncio.get_running_loop().time() + LOG_FLUSH_INTERVAL
+        while len(batch) < LOG_BATCH_SIZE:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(log_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        try:
+            async with db_write():
+                await db.executemany(
+                    "INSERT INTO action_log (action_type, user_id, order_id, description, action_date) VALUES (?, ?, ?, ?, ?)",
+                    batch
+                )
+        except aiosqlite.Error as e:
+            logger.error("Ошибка записи журнала действий (%s записей): %s", len(batch), e, exc_info=True)
+        finally:
+            for _ in batch:
+                log_queue.task_done()
+
+# Кэш имен сопровождающих: telegram_id -> username
+USERNAME_CACHE: dict[int, str] = {}
+
+# Имя сопровождающего по Telegram ID (None, если не зарегистрирован)
+async def get_username(telegram_id: int) -> str | None:
+    username = USERNAME_CACHE.get(telegram_id)
+    if username is None:
+        cursor = await db.execute("SELECT username FROM escorts WHERE telegram_id = ?", (telegram_id,))
+        row = await cursor.fetchone()
+        if not row:
+            return None
+        username = USERNAME_CACHE[telegram_id] = row[0] or "Unknown"
+    return username
+
+# Рассылка пачками: темп задает send_limiter, пачки ограничивают число одновременных задач
+NOTIFY_BATCH_SIZE = 20
+
+async def broadcast(chat_ids, text: str, **kwargs):
+    for i in range(0, len(chat_ids), NOTIFY_BATCH_SIZE):
+        batch = chat_ids[i:i + NOTIFY_BATCH_SIZE]
+        await asyncio.gather(*(safe_send_message(chat_id, text, **kwargs) for chat_id in batch), return_exceptions=True)
 
 # Уведомление админов
 async def notify_admins(message: str, reply_to_user_id: int | None = None):
-    tasks = []
-    for admin_id in ADMIN_IDS:
-        if reply_to_user_id:
-            markup = InlineKeyboardBuilder()
-            markup.add(InlineKeyboardButton(text="Ответить", callback_data=f"reply_{reply_to_user_id}"))
-            tasks.append(safe_send_message(admin_id, message, reply_markup=markup.as_markup()))
-        else:
-            tasks.append(safe_send_message(admin_id, message))
-    await asyncio.gather(*tasks, return_exceptions=True)
+    kwargs = {}
+    if reply_to_user_id:
+        markup = InlineKeyboardBuilder()
+        markup.add(InlineKeyboardButton(text="Ответить", callback_data=f"reply_{reply_to_user_id}"))
+        kwargs["reply_markup"] = markup.as_markup()
+    await broadcast(ADMIN_IDS_LIST, message, **kwargs)
+
+# Очередь фоновых уведомлений: (chat_id, text), chat_id=None — рассылка администраторам
+notify_queue: asyncio.Queue = asyncio.Queue()
+NOTIFY_DRAIN_TIMEOUT = 10
+
+def queue_notification(chat_id: int | None, text: str):
+    notify_queue.put_nowait((chat_id, text))
+
+# Фоновая отправка уведомлений из очереди
+async def notify_worker():
+    while True:
+        chat_id, text = await notify_queue.get()
+        try:
+            if chat_id is None:
+                await notify_admins(text)
+            else:
+                await safe_send_message(chat_id, text)
+        except Exception as e:
+            logger.error("Ошибка фонового уведомления для chat_id %s: %s", chat_id, e)
+        finally:
+            notify_queue.task_done()
 
 # Уведомление сквада
 async def notify_squad(squad_id: int | None, message: str):
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            query = "SELECT telegram_id FROM escorts WHERE squad_id IS NULL" if squad_id is None else \
-                    "SELECT telegram_id FROM escorts WHERE squad_id = ?"
-            params = () if squad_id is None else (squad_id,)
-            cursor = await conn.execute(query, params)
-            escorts = await cursor.fetchall()
-            tasks = [safe_send_message(telegram_id, message) for (telegram_id,) in escorts]
-            await asyncio.gather(*tasks, return_exceptions=True)
+        query = "SELECT telegram_id FROM escorts WHERE squad_id IS NULL" if squad_id is None else \
+                "SELECT telegram_id FROM escorts WHERE squad_id = ?"
+        params = () if squad_id is None else (squad_id,)
+        escorts = await db.execute_fetchall(query, params)
+        await broadcast([telegram_id for (telegram_id,) in escorts], message)
     except aiosqlite.Error as e:
-        logger.error(f"Ошибка уведомления сквада {squad_id}: {e}\n{traceback.format_exc()}")
-
-# Информация о скваде
-async def get_squad_info(squad_id: int):
+        logger.error("Ошибка уведомления сквада %s: %s", squad_id, e, exc_info=True)
+
+# Сводка по сквадам одним запросом: участники и их баланс — одним проходом по escorts через LEFT JOIN,
+# заказы сквада — подзапросом (join с orders размножил бы строки участников)
+SQUAD_STATS_SQL = """
+    SELECT s.id, s.name,
+           (SELECT COUNT(*) FROM orders o WHERE o.squad_id = s.id),
+           COALESCE(SUM(e.balance), 0),
+           s.rating, s.rating_count,
+           COUNT(e.id)
+    FROM squads s
+    LEFT JOIN escorts e ON e.squad_id = s.id
+    GROUP BY s.id
+    ORDER BY s.name
+"""
+
+# Экспорт заказов в CSV (синхронно, вызывается через asyncio.to_thread), строки читаются порциями
+EXPORT_FETCH_SIZE = 1000
+
+def export_orders_to_csv():
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute(
-                "SELECT name, total_orders, total_balance, rating, rating_count FROM squads WHERE id = ?",
-                (squad_id,)
+        with closing(sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True)) as conn:
+            cursor = conn.execute(
+                "SELECT memo_order_id, customer_info, amount, status, created_at FROM orders"
             )
-            squad = await cursor.fetchone()
-            if not squad:
-                return None
-            cursor = await conn.execute("SELECT COUNT(*) FROM escorts WHERE squad_id = ?", (squad_id,))
-            member_count = (await cursor.fetchone())[0]
-            return {"squad": squad, "member_count": member_count}
-    except aiosqlite.Error as e:
-        logger.error(f"Ошибка получения информации о скваде {squad_id}: {e}\n{traceback.format_exc()}")
-        return None
-
-# Экспорт заказов в CSV
-async def export_orders_to_csv():
-    try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute("SELECT * FROM orders")
-            orders = await cursor.fetchall()
-            if not orders:
+            rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+            if not rows:
                 return None
             filename = f"orders_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
             with open(filename, 'w', newline='', encoding='utf-8') as f:
                 writer = csv.writer(f)
                 writer.writerow(['memo_order_id', 'customer_info', 'amount', 'status', 'created_at'])
-                writer.writerows(orders)
+                while rows:
+                    writer.writerows(rows)
+                    rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
             return filename
-    except (aiosqlite.Error, OSError) as e:
-        logger.error(f"Ошибка экспорта заказов: {e}\n{traceback.format_exc()}")
+    except (sqlite3.Error, OSError) as e:
+        logger.error("Ошибка экспорта заказов: %s", e, exc_info=True)
         return None
 
-# Обработчик группы "Заказы"
-@dp.message(lambda message: message.text == "Заказы")
-async def orders_menu(message: types.Message, state: FSMContext):
-    user_id = message.from_user.id
-    if not is_admin(user_id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(user_id))
-        return
-    try:
-        await message.answer("Меню заказов:", reply_markup=get_orders_keyboard())
-        await state.clear()
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в orders_menu для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_admin_keyboard())
-
-# Обработчик группы "Сквады"
-@dp.message(lambda message: message.text == "Сквады")
-async def squads_menu(message: types.Message, state: FSMContext):
-    user_id = message.from_user.id
-    if not is_admin(user_id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(user_id))
-        return
-    try:
-        await message.answer("Меню сквадов:", reply_markup=get_squads_keyboard())
-        await state.clear()
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в squads_menu для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_admin_keyboard())
-
-# Обработчик группы "Сопровождающие"
-@dp.message(lambda message: message.text == "Сопровождающие")
-async def escorts_menu(message: types.Message, state: FSMContext):
-    user_id = message.from_user.id
-    if not is_admin(user_id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(user_id))
-        return
-    try:
-        await message.answer("Меню сопровождающих:", reply_markup=get_escorts_keyboard())
-        await state.clear()
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в escorts_menu для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_admin_keyboard())
-
-# Обработчик группы "Бан/ограничение"
-@dp.message(lambda message: message.text == "Бан/ограничение")
-async def ban_restrict_menu(message: types.Message, state: FSMContext):
-    user_id = message.from_user.id
-    if not is_admin(user_id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(user_id))
-        return
-    try:
-        await message.answer("Меню бана/ограничений:", reply_markup=get_ban_restrict_keyboard())
-        await state.clear()
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в ban_restrict_menu для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_admin_keyboard())
-
-# Обработчик группы "Баланс"
-@dp.message(lambda message: message.text == "Баланс")
-async def balances_menu(message: types.Message, state: FSMContext):
-    user_id = message.from_user.id
-    if not is_admin(user_id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(user_id))
-        return
-    try:
-        await message.answer("Меню балансов:", reply_markup=get_balances_keyboard())
-        await state.clear()
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в balances_menu для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_admin_keyboard())
+# Middleware: права администратора проверяются один раз на апдейт,
+# обработчики с флагом admin_only не вызываются для остальных пользователей
+class AdminMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event: types.Message | types.CallbackQuery, data: dict):
+        user_id = event.from_user.id
+        if get_flag(data, "admin_only") and not is_admin(user_id):
+            if isinstance(event, types.CallbackQuery):
+                await event.answer(MESSAGES["no_access"], show_alert=True)
+            else:
+                await event.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(user_id))
+            return
+        return await handler(event, data)
+
+dp.message.middleware(AdminMiddleware())
+dp.callback_query.middleware(AdminMiddleware())
+
+# Декоратор админ-обработчиков: общая обработка ошибок, доступ проверяет AdminMiddleware
+def admin_handler(keyboard, invalid_input: str | None = None):
+    def decorator(handler):
+        flags.admin_only(handler)
+
+        @wraps(handler)
+        async def wrapper(message: types.Message, state: FSMContext):
+            user_id = message.from_user.id
+            try:
+                return await handler(message, state)
+            except ValueError:
+                if invalid_input is None:
+                    raise
+                await message.answer(invalid_input, reply_markup=CANCEL_KB)
+            except aiosqlite.Error as e:
+                logger.error("Ошибка базы данных в %s для %s: %s", handler.__name__, user_id, e)
+                await message.answer("Ошибка базы данных.", reply_markup=keyboard)
+                await state.clear()
+            except TelegramAPIError as e:
+                logger.error("Ошибка Telegram API в %s для %s: %s", handler.__name__, user_id, e)
+                await message.answer(MESSAGES["error"], reply_markup=keyboard)
+                await state.clear()
+        return wrapper
+    return decorator
+
+# Декоратор пользовательских обработчиков: общая обработка ошибок с возвратом в главное меню
+def user_handler(handler):
+    @wraps(handler)
+    async def wrapper(message: types.Message, state: FSMContext):
+        user_id = message.from_user.id
+        try:
+            return await handler(message, state)
+        except aiosqlite.Error as e:
+            logger.error("Ошибка базы данных в %s для %s: %s", handler.__name__, user_id, e)
+            await message.answer("Ошибка базы данных.", reply_markup=get_menu_keyboard(user_id))
+            await state.clear()
+        except TelegramAPIError as e:
+            logger.error("Ошибка Telegram API в %s для %s: %s", handler.__name__, user_id, e)
+            await message.answer(MESSAGES["error"], reply_markup=get_menu_keyboard(user_id))
+            await state.clear()
+    return wrapper
+
+# Админ-панель и её разделы: текст кнопки -> (заголовок, клавиатура раздела)
+MENU_MAP = {
+    "Админ-панель": ("Админ-панель:", ADMIN_KB),
+    "Заказы": ("Меню заказов:", ORDERS_KB),
+    "Сквады": ("Меню сквадов:", SQUADS_KB),
+    "Сопровождающие": ("Меню сопровождающих:", ESCORTS_KB),
+    "Бан/ограничение": ("Меню бана/ограничений:", BAN_RESTRICT_KB),
+    "Баланс": ("Меню балансов:", BALANCES_KB),
+    "Отчеты/справка": ("Меню отчетов:", REPORTS_KB),
+}
 
-# Обработчик группы "Отчеты/справка"
-@dp.message(lambda message: message.text == "Отчеты/справка")
-async def reports_menu(message: types.Message, state: FSMContext):
-    user_id = message.from_user.id
-    try:
-        await message.answer("Меню отчетов:", reply_markup=get_reports_keyboard())
-        await state.clear()
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в reports_menu для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_admin_keyboard())
+# Обработчик админ-панели и её разделов
+@dp.message(F.text.in_(MENU_MAP))
+@admin_handler(ADMIN_KB)
+async def section_menu(message: types.Message, state: FSMContext):
+    title, keyboard = MENU_MAP[message.text]
+    await message.answer(title, reply_markup=keyboard)
+    await state.clear()
 
 # Обработчик добавления сквада
-@dp.message(lambda message: message.text == "Добавить сквад")
+@dp.message(F.text == "Добавить сквад")
+@flags.admin_only
 async def add_squad(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    if not is_admin(user_id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(user_id))
-        return
     try:
-        await message.answer("Введите название нового сквада:", reply_markup=get_cancel_keyboard(True))
+        await message.answer("Введите название нового сквада:", reply_markup=CANCEL_KB)
         await state.set_state(Form.squad_name)
     except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в add_squad для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_squads_keyboard())
+        logger.error("Ошибка Telegram API в add_squad для %s: %s", user_id, e)
+        await message.answer(MESSAGES["error"], reply_markup=SQUADS_KB)
 
 @dp.message(Form.squad_name)
+@flags.admin_only
 async def process_squad_name(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     if message.text == "Отмена":
-        await message.answer(MESSAGES["cancel_action"], reply_markup=get_squads_keyboard())
+        await message.answer(MESSAGES["cancel_action"], reply_markup=SQUADS_KB)
         await state.clear()
         return
     squad_name = message.text.strip()
     if not squad_name:
-        await message.answer("Название сквада не может быть пустым.", reply_markup=get_cancel_keyboard(True))
+        await message.answer("Название сквада не может быть пустым.", reply_markup=CANCEL_KB)
         return
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute("SELECT id FROM squads WHERE name = ?", (squad_name,))
-            if await cursor.fetchone():
-                await message.answer(f"Сквад '{squad_name}' уже существует.", reply_markup=get_cancel_keyboard(True))
-                return
-            await conn.execute("INSERT INTO squads (name) VALUES (?)", (squad_name,))
-            await conn.commit()
-            await message.answer(f"Сквад '{squad_name}' успешно создан!", reply_markup=get_squads_keyboard())
-            await log_action("add_squad", user_id, None, f"Создан сквад '{squad_name}'")
-            await state.clear()
+        async with db_write():
+            cursor = await db.execute(
+                "INSERT INTO squads (name) VALUES (?) ON CONFLICT(name) DO NOTHING RETURNING id", (squad_name,)
+            )
+            created = await cursor.fetchone()
+        if not created:
+            await message.answer(f"Сквад '{squad_name}' уже существует.", reply_markup=CANCEL_KB)
+            return
+        await message.answer(f"Сквад '{squad_name}' успешно создан!", reply_markup=SQUADS_KB)
+        log_action("add_squad", user_id, None, f"Создан сквад '{squad_name}'")
+        await state.clear()
     except aiosqlite.Error as e:
-        logger.error(f"Ошибка базы данных в process_squad_name для {user_id}: {e}")
-        await message.answer("Ошибка базы данных.", reply_markup=get_squads_keyboard())
+        logger.error("Ошибка базы данных в process_squad_name для %s: %s", user_id, e)
+        await message.answer("Ошибка базы данных.", reply_markup=SQUADS_KB)
         await state.clear()
     except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в process_squad_name для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_squads_keyboard())
+        logger.error("Ошибка Telegram API в process_squad_name для %s: %s", user_id, e)
+        await message.answer(MESSAGES["error"], reply_markup=SQUADS_KB)
         await state.clear()
 
 # Обработчик списка сквадов
-@dp.message(lambda message: message.text == "Список сквадов")
+@dp.message(F.text == "Список сквадов")
+@flags.admin_only
 async def list_squads(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    if not is_admin(user_id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(user_id))
-        return
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute("SELECT id, name FROM squads")
-            squads = await cursor.fetchall()
-            if not squads:
-                await message.answer(MESSAGES["no_squads"], reply_markup=get_squads_keyboard())
-                return
-            response = "Список сквадов:\n"
-            for squad_id, name in squads:
-                squad_info = await get_squad_info(squad_id)
-                if squad_info:
-                    squad_data, member_count = squad_info["squad"], squad_info["member_count"]
-                    name, total_orders, total_balance, rating, rating_count = squad_data
-                    response += (
-                        f"{name}\n"
-                        f"  Заказов: {total_orders}\n"
-                        f"  Баланс: {total_balance:.2f} руб.\n"
-                        f"  Рейтинг: {rating:.1f} ({rating_count} оценок)\n"
-                        f"  Участников: {member_count}\n\n"
-                    )
-            await message.answer(response, reply_markup=get_squads_keyboard())
+        squads = await db.execute_fetchall(SQUAD_STATS_SQL)
+        if not squads:
+            await message.answer(MESSAGES["no_squads"], reply_markup=SQUADS_KB)
+            return
+        parts = ["Список сквадов:"]
+        parts.extend(
+            f"{name}\n"
+            f"  Заказов: {total_orders}\n"
+            f"  Баланс: {total_balance:.2f} руб.\n"
+            f"  Рейтинг: {rating:.1f} ({rating_count} оценок)\n"
+            f"  Участников: {member_count}\n"
+            for _, name, total_orders, total_balance, rating, rating_count, member_count in squads
+        )
+        await answer_chunked(message, parts, reply_markup=SQUADS_KB)
     except aiosqlite.Error as e:
-        logger.error(f"Ошибка базы данных в list_squads для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_squads_keyboard())
+        logger.error("Ошибка базы данных в list_squads для %s: %s", user_id, e)
+        await message.answer(MESSAGES["error"], reply_markup=SQUADS_KB)
     except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в list_squads для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_squads_keyboard())
+        logger.error("Ошибка Telegram API в list_squads для %s: %s", user_id, e)
+        await message.answer(MESSAGES["error"], reply_markup=SQUADS_KB)
 
 # Обработчик расформирования сквада
-@dp.message(lambda message: message.text == "Расформировать сквад")
+@dp.message(F.text == "Расформировать сквад")
+@flags.admin_only
 async def delete_squad(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    if not is_admin(user_id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(user_id))
-        return
     try:
-        await message.answer("Введите название сквада для расформирования:", reply_markup=get_cancel_keyboard(True))
+        await message.answer("Введите название сквада для расформирования:", reply_markup=CANCEL_KB)
         await state.set_state(Form.delete_squad)
     except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в delete_squad для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_squads_keyboard())
+        logger.error("Ошибка Telegram API в delete_squad для %s: %s", user_id, e)
+        await message.answer(MESSAGES["error"], reply_markup=SQUADS_KB)
 
 @dp.message(Form.delete_squad)
+@flags.admin_only
 async def process_delete_squad(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     if message.text == "Отмена":
-        await message.answer(MESSAGES["cancel_action"], reply_markup=get_squads_keyboard())
+        await message.answer(MESSAGES["cancel_action"], reply_markup=SQUADS_KB)
         await state.clear()
         return
     squad_name = message.text.strip()
     if not squad_name:
-        await message.answer("Название сквада не может быть пустым.", reply_markup=get_cancel_keyboard(True))
+        await message.answer("Название сквада не может быть пустым.", reply_markup=CANCEL_KB)
         return
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute("SELECT id FROM squads WHERE name = ?", (squad_name,))
+        async with db_write():
+            # Участников отвязывает триггер trg_squads_unlink_escorts из schema.sql
+            cursor = await db.execute("DELETE FROM squads WHERE name = ? RETURNING id", (squad_name,))
             squad = await cursor.fetchone()
-            if not squad:
-                await message.answer(f"Сквад '{squad_name}' не найден.", reply_markup=get_cancel_keyboard(True))
-                return
-            await conn.execute("DELETE FROM squads WHERE name = ?", (squad_name,))
-            await conn.commit()
-            await message.answer(f"Сквад '{squad_name}' успешно расформирован.", reply_markup=get_squads_keyboard())
-            await log_action("delete_squad", user_id, None, f"Расформирован сквад '{squad_name}'")
-            await state.clear()
+        if not squad:
+            await message.answer(f"Сквад '{squad_name}' не найден.", reply_markup=CANCEL_KB)
+            return
+        await message.answer(f"Сквад '{squad_name}' успешно расформирован.", reply_markup=SQUADS_KB)
+        log_action("delete_squad", user_id, None, f"Расформирован сквад '{squad_name}'")
+        await state.clear()
     except aiosqlite.Error as e:
-        logger.error(f"Ошибка базы данных в process_delete_squad для {user_id}: {e}")
-        await message.answer("Ошибка базы данных.", reply_markup=get_squads_keyboard())
+        logger.error("Ошибка базы данных в process_delete_squad для %s: %s", user_id, e)
+        await message.answer("Ошибка базы данных.", reply_markup=SQUADS_KB)
         await state.clear()
     except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в process_delete_squad для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_squads_keyboard())
+        logger.error("Ошибка Telegram API в process_delete_squad для %s: %s", user_id, e)
+        await message.answer(MESSAGES["error"], reply_markup=SQUADS_KB)
         await state.clear()
 
 # Обработчик добавления сопровождающего
-@dp.message(lambda message: message.text == "Добавить сопровождающего")
+@dp.message(F.text == "Добавить сопровождающего")
+@admin_handler(ESCORTS_KB)
 async def add_escort(message: types.Message, state: FSMContext):
-    user_id = message.from_user.id
-    if not is_admin(user_id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(user_id))
-        return
-    try:
-        await message.answer(
-            "Введите данные сопровождающего (Telegram ID, @username, PUBG ID, Название сквада):",
-            reply_markup=get_cancel_keyboard(True)
-        )
-        await state.set_state(Form.escort_info)
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в add_escort для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_escorts_keyboard())
+    await message.answer(
+        "Введите данные сопровождающего (Telegram ID, @username, PUBG ID, Название сквада):",
+        reply_markup=CANCEL_KB
+    )
+    await state.set_state(Form.escort_info)
 
 @dp.message(Form.escort_info)
+@admin_handler(ESCORTS_KB, invalid_input=MESSAGES["invalid_format"] + "\nПример: 123456789, @username, PUBG123, Название сквада")
 async def process_escort_info(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     if message.text == "Отмена":
-        await message.answer(MESSAGES["cancel_action"], reply_markup=get_escorts_keyboard())
+        await message.answer(MESSAGES["cancel_action"], reply_markup=ESCORTS_KB)
         await state.clear()
         return
-    try:
-        parts = [x.strip() for x in message.text.split(", ", 3)]
-        if len(parts) != 4:
-            await message.answer(
-                MESSAGES["invalid_format"] + "\nПример: 123456789, @username, PUBG123, Название сквада",
-                reply_markup=get_cancel_keyboard(True)
-            )
-            return
-        telegram_id, username, pubg_id, squad_name = parts
-        telegram_id = int(telegram_id)
-        if telegram_id == user_id:
-            await message.answer("Нельзя добавить самого себя!", reply_markup=get_cancel_keyboard(True))
-            return
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute("SELECT id FROM squads WHERE name = ?", (squad_name,))
-            squad = await cursor.fetchone()
-            squad_id = squad[0] if squad else None
-            if not squad:
-                await message.answer(f"Сквад '{squad_name}' не найден.", reply_markup=get_cancel_keyboard(True))
-                return
-            cursor = await conn.execute("SELECT telegram_id FROM escorts WHERE telegram_id = ?", (telegram_id,))
-            if await cursor.fetchone():
-                await message.answer(f"Пользователь с Telegram ID {telegram_id} уже зарегистрирован.", reply_markup=get_cancel_keyboard(True))
-                return
-            await conn.execute(
-                "INSERT INTO escorts (telegram_id, username, pubg_id, squad_id) VALUES (?, ?, ?, ?)",
-                (telegram_id, username, pubg_id, squad_id)
-            )
-            await conn.commit()
-            await message.answer(f"Сопровождающий {username} успешно добавлен!", reply_markup=get_escorts_keyboard())
-            await log_action("add_escort", user_id, None, f"Добавлен сопровождающий {username} ID: {telegram_id}")
-            await state.clear()
-    except ValueError:
+    parts = _COMMA_RE.split(message.text.strip(), maxsplit=3)
+    if len(parts) != 4:
         await message.answer(
             MESSAGES["invalid_format"] + "\nПример: 123456789, @username, PUBG123, Название сквада",
-            reply_markup=get_cancel_keyboard(True)
+            reply_markup=CANCEL_KB
         )
-    except aiosqlite.Error as e:
-        logger.error(f"Ошибка базы данных в process_escort_info для {user_id}: {e}")
-        await message.answer("Ошибка базы данных.", reply_markup=get_escorts_keyboard())
-        await state.clear()
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в process_escort_info для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_escorts_keyboard())
-        await state.clear()
+        return
+    telegram_id, username, pubg_id, squad_name = parts
+    telegram_id = int(telegram_id)
+    if telegram_id == user_id:
+        await message.answer("Нельзя добавить самого себя!", reply_markup=CANCEL_KB)
+        return
+    # Вставка сразу с поиском сквада; причину отказа выясняем только на редком пути
+    async with db_write():
+        cursor = await db.execute(
+            "INSERT INTO escorts (telegram_id, username, pubg_id, squad_id) "
+            "SELECT ?, ?, ?, id FROM squads WHERE name = ? "
+            "ON CONFLICT(telegram_id) DO NOTHING RETURNING is_banned, ban_until, restrict_until",
+            (telegram_id, username, pubg_id, squad_name)
+        )
+        inserted = await cursor.fetchone()
+    if inserted is None:
+        cursor = await db.execute("SELECT 1 FROM squads WHERE name = ?", (squad_name,))
+        if await cursor.fetchone() is None:
+            await message.answer(f"Сквад '{squad_name}' не найден.", reply_markup=CANCEL_KB)
+        else:
+            await message.answer(f"Пользователь с Telegram ID {telegram_id} уже зарегистрирован.", reply_markup=CANCEL_KB)
+        return
+    _access_status[telegram_id] = tuple(inserted)
+    USERNAME_CACHE[telegram_id] = username
+    await message.answer(f"Сопровождающий {username} успешно добавлен!", reply_markup=ESCORTS_KB)
+    log_action("add_escort", user_id, None, f"Добавлен сопровождающий {username} ID: {telegram_id}")
+    await state.clear()
 
 # Обработчик удаления сопровождающего
-@dp.message(lambda message: message.text == "Удалить сопровождающего")
+@dp.message(F.text == "Удалить сопровождающего")
+@admin_handler(ESCORTS_KB)
 async def remove_escort(message: types.Message, state: FSMContext):
-    user_id = message.from_user.id
-    if not is_admin(user_id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(user_id))
-        return
-    try:
-        await message.answer("Введите Telegram ID сопровождающего для удаления:", reply_markup=get_cancel_keyboard(True))
-        await state.set_state(Form.remove_escort)
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в remove_escort для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_escorts_keyboard())
+    await message.answer("Введите Telegram ID сопровождающего для удаления:", reply_markup=CANCEL_KB)
+    await state.set_state(Form.remove_escort)
 
 @dp.message(Form.remove_escort)
+@admin_handler(ESCORTS_KB)
 async def process_remove_escort(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     if message.text == "Отмена":
-        await message.answer(MESSAGES["cancel_action"], reply_markup=get_escorts_keyboard())
+        await message.answer(MESSAGES["cancel_action"], reply_markup=ESCORTS_KB)
         await state.clear()
         return
-    try:
-        telegram_id = int(message.text.strip())
-        if telegram_id == user_id:
-            await message.answer("Нельзя удалить самого себя!", reply_markup=get_cancel_keyboard(True))
-            return
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute("SELECT username FROM escorts WHERE telegram_id = ?", (telegram_id,))
-            user = await cursor.fetchone()
-            if not user:
-                await message.answer(f"Пользователь с Telegram ID {telegram_id} не найден.", reply_markup=get_cancel_keyboard(True))
-                return
-            username = user[0]
-            await conn.execute("DELETE FROM escorts WHERE telegram_id = ?", (telegram_id,))
-            await conn.commit()
-            await message.answer(f"Сопровождающий {username} удалён.", reply_markup=get_escorts_keyboard())
-            await log_action("remove_escort", user_id, None, f"Удалён сопровождающий {username} ID: {telegram_id}")
-            await state.clear()
-    except ValueError:
-        await message.answer("Неверный формат Telegram ID.", reply_markup=get_cancel_keyboard(True))
-    except aiosqlite.Error as e:
-        logger.error(f"Ошибка базы данных в process_remove_escort для {user_id}: {e}")
-        await message.answer("Ошибка базы данных.", reply_markup=get_escorts_keyboard())
-        await state.clear()
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в process_remove_escort для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_escorts_keyboard())
-        await state.clear()
+    telegram_id = parse_telegram_id(message.text)
+    if telegram_id is None:
+        await message.answer("Неверный формат Telegram ID.", reply_markup=CANCEL_KB)
+        return
+    if telegram_id == user_id:
+        await message.answer("Нельзя удалить самого себя!", reply_markup=CANCEL_KB)
+        return
+    async with db_write():
+        cursor = await db.execute("DELETE FROM escorts WHERE telegram_id = ? RETURNING username", (telegram_id,))
+        row = await cursor.fetchone()
+        _profit_cache.pop(telegram_id, None)
+        USERNAME_CACHE.pop(telegram_id, None)
+    _access_status.pop(telegram_id, None)
+    if row is None:
+        await message.answer(f"Пользователь с Telegram ID {telegram_id} не найден.", reply_markup=CANCEL_KB)
+        return
+    username = row[0] or "Unknown"
+    await message.answer(f"Сопровождающий {username} удалён.", reply_markup=ESCORTS_KB)
+    log_action("remove_escort", user_id, None, f"Удалён сопровождающий {username} ID: {telegram_id}")
+    await state.clear()
 
 # Обработчик списка пользователей
-@dp.message(lambda message: message.text == "Пользователи")
+# Страница списка сопровождающих после telegram_id = after (keyset-пагинация).
+# Возвращает текст и клавиатуру с кнопкой «Далее», если есть следующая страница; None — если страница пуста
+ESCORTS_PAGE_SIZE = 20
+
+async def escorts_page(after: int = 0):
+    rows = await db.execute_fetchall(
+        "SELECT telegram_id, username FROM escorts WHERE telegram_id > ? ORDER BY telegram_id LIMIT ?",
+        (after, ESCORTS_PAGE_SIZE + 1)
+    )
+    if not rows:
+        return None
+    page = rows[:ESCORTS_PAGE_SIZE]
+    text = "Список сопровождающих:\n" + "\n".join(f"{username} (ID: {telegram_id})" for telegram_id, username in page)
+    if len(rows) <= ESCORTS_PAGE_SIZE:
+        return text, ESCORTS_KB
+    builder = InlineKeyboardBuilder.from_markup(ESCORTS_KB)
+    builder.row(InlineKeyboardButton(text="Далее", callback_data=f"escorts_after_{page[-1][0]}"))
+    return text, builder.as_markup()
+
+@dp.message(F.text == "Пользователи")
+@admin_handler(ESCORTS_KB)
 async def get_escorts(message: types.Message, state: FSMContext):
-    user_id = message.from_user.id
-    if not is_admin(user_id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(user_id))
+    page = await escorts_page()
+    if page is None:
+        await message.answer(MESSAGES["no_escorts"], reply_markup=ESCORTS_KB)
+        return
+    text, markup = page
+    await message.answer(text, reply_markup=markup)
+
+# Следующая страница списка сопровождающих по кнопке «Далее»
+@dp.callback_query(F.data.startswith("escorts_after_"))
+@flags.admin_only
+async def escorts_next_page(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
+    after = parse_telegram_id(callback.data.removeprefix("escorts_after_"))
+    if after is None:
+        await callback.answer()
         return
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute("SELECT telegram_id, username FROM escorts")
-            escorts = await cursor.fetchall()
-            if not escorts:
-                await message.answer(MESSAGES["no_escorts"], reply_markup=get_escorts_keyboard())
-                return
-            response = "Список сопровождающих:\n"
-            for telegram_id, username in escorts:
-                response += f"{username} (ID: {telegram_id})\n"
-            await message.answer(response, reply_markup=get_escorts_keyboard())
+        page = await escorts_page(after)
+        if page is None:
+            await callback.answer(MESSAGES["no_escorts"])
+            return
+        text, markup = page
+        await callback.message.edit_text(text, reply_markup=markup)
+        await callback.answer()
     except aiosqlite.Error as e:
-        logger.error(f"Ошибка базы данных в get_escorts для {user_id}: {e}")
-        await message.answer("Ошибка базы данных.", reply_markup=get_escorts_keyboard())
+        logger.error("Ошибка базы данных в escorts_next_page для %s: %s", user_id, e)
+        await callback.answer("Ошибка базы данных.")
     except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в get_escorts для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_escorts_keyboard())
+        logger.error("Ошибка Telegram API в escorts_next_page для %s: %s", user_id, e)
 
 # Обработчик добавления заказа
-@dp.message(lambda message: message.text == "Добавить заказ")
+@dp.message(F.text == "Добавить заказ")
+@admin_handler(ORDERS_KB)
 async def add_order(message: types.Message, state: FSMContext):
-    user_id = message.from_user.id
-    if not is_admin(user_id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(user_id))
-        return
-    try:
-        await message.answer("Введите ID заказа, клиента и сумму (через запятую):", reply_markup=get_cancel_keyboard(True))
-        await state.set_state(Form.add_order)
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в add_order для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_orders_keyboard())
+    await message.answer("Введите ID заказа, клиента и сумму (через запятую):", reply_markup=CANCEL_KB)
+    await state.set_state(Form.add_order)
 
 @dp.message(Form.add_order)
+@admin_handler(ORDERS_KB, invalid_input=MESSAGES["invalid_format"] + "\nПример: ORDER123, Клиент Иванов, 5000")
 async def process_add_order(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     if message.text == "Отмена":
-        await message.answer(MESSAGES["cancel_action"], reply_markup=get_orders_keyboard())
+        await message.answer(MESSAGES["cancel_action"], reply_markup=ORDERS_KB)
         await state.clear()
         return
-    try:
-        parts = [x.strip() for x in message.text.split(", ", 2)]
-        if len(parts) != 3:
-            await message.answer(MESSAGES["invalid_format"] + "\nПример: ORDER123, Клиент Иванов, 5000", reply_markup=get_cancel_keyboard(True))
-            return
-        order_id, customer, amount_str = parts
-        amount = float(amount_str)
-        if amount <= 0 or not order_id or not customer:
-            await message.answer("ID заказа и описание не могут быть пустыми, сумма должна быть положительной.", reply_markup=get_cancel_keyboard(True))
-            return
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute("SELECT id FROM orders WHERE memo_order_id = ?", (order_id,))
-            if await cursor.fetchone():
-                await message.answer(f"Заказ #{order_id} уже существует.", reply_markup=get_cancel_keyboard(True))
-                return
-            await conn.execute("INSERT INTO orders (memo_order_id, customer_info, amount) VALUES (?, ?, ?)", (order_id, customer, amount))
-            await conn.commit()
-            await message.answer(
-                MESSAGES["order_added"].format(order_id=order_id, customer=customer, amount=amount, description=""),
-                reply_markup=get_orders_keyboard()
-            )
-            await log_action("add_order", user_id, order_id, f"Добавлен заказ #{order_id} для {customer}, сумма: {amount:.2f}")
-            await notify_admins(f"Новый заказ #{order_id} добавлен!\nКлиент: {customer}\nСумма: {amount:.2f} руб.")
-            await state.clear()
-    except ValueError:
-        await message.answer(MESSAGES["invalid_format"] + "\nПример: ORDER123, Клиент Иванов, 5000", reply_markup=get_cancel_keyboard(True))
-    except aiosqlite.Error as e:
-        logger.error(f"Ошибка базы данных в process_add_order для {user_id}: {e}")
-        await message.answer("Ошибка базы данных.", reply_markup=get_orders_keyboard())
-        await state.clear()
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в process_add_order для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_orders_keyboard())
-        await state.clear()
+    order_id, _, rest = message.text.partition(",")
+    customer, sep, amount_str = rest.rpartition(",")
+    if not sep:
+        await message.answer(MESSAGES["invalid_format"] + "\nПример: ORDER123, Клиент Иванов, 5000", reply_markup=CANCEL_KB)
+        return
+    order_id, customer = order_id.strip(), customer.strip()
+    amount = float(amount_str)
+    if amount <= 0 or not order_id or not customer:
+        await message.answer("ID заказа и описание не могут быть пустыми, сумма должна быть положительной.", reply_markup=CANCEL_KB)
+        return
+    # memo_order_id не объявлен UNIQUE, поэтому вместо ON CONFLICT — INSERT ... SELECT ... WHERE NOT EXISTS
+    async with db_write():
+        cursor = await db.execute(
+            "INSERT INTO orders (memo_order_id, customer_info, amount) SELECT ?, ?, ? "
+            "WHERE NOT EXISTS (SELECT 1 FROM orders WHERE memo_order_id = ?) RETURNING id",
+            (order_id, customer, amount, order_id)
+        )
+        inserted = await cursor.fetchone()
+    if inserted is None:
+        await message.answer(f"Заказ #{order_id} уже существует.", reply_markup=CANCEL_KB)
+        return
+    _profit_cache.clear()
+    await message.answer(
+        MESSAGES["order_added"](order_id=order_id, customer=customer, amount=amount, description=""),
+        reply_markup=ORDERS_KB
+    )
+    log_action("add_order", user_id, order_id, f"Добавлен заказ #{order_id} для {customer}, сумма: {amount:.2f}")
+    queue_notification(None, f"Новый заказ #{order_id} добавлен!\nКлиент: {customer}\nСумма: {amount:.2f} руб.")
+    await state.clear()
 
 # Обработчик начисления баланса
-@dp.message(lambda message: message.text == "Начислить")
+@dp.message(F.text == "Начислить")
+@admin_handler(BALANCES_KB)
 async def add_balance(message: types.Message, state: FSMContext):
-    user_id = message.from_user.id
-    if not is_admin(user_id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(user_id))
-        return
-    try:
-        await message.answer("Введите Telegram ID и сумму для начисления (через запятую):", reply_markup=get_cancel_keyboard(True))
-        await state.set_state(Form.balance_amount)
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в add_balance для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_balances_keyboard())
+    await message.answer("Введите Telegram ID и сумму для начисления (через запятую):", reply_markup=CANCEL_KB)
+    await state.set_state(Form.balance_amount)
 
 @dp.message(Form.balance_amount)
+@admin_handler(BALANCES_KB, invalid_input=MESSAGES["invalid_format"] + "\nПример: 123456789, 1000")
 async def process_balance_amount(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     if message.text == "Отмена":
-        await message.answer(MESSAGES["cancel_action"], reply_markup=get_balances_keyboard())
+        await message.answer(MESSAGES["cancel_action"], reply_markup=BALANCES_KB)
         await state.clear()
         return
-    try:
-        parts = [x.strip() for x in message.text.split(", ", 1)]
-        if len(parts) != 2:
-            await message.answer(MESSAGES["invalid_format"] + "\nПример: 123456789, 1000", reply_markup=get_cancel_keyboard(True))
-            return
-        telegram_id, amount_str = parts
-        telegram_id = int(telegram_id)
-        amount = float(amount_str)
-        if amount < 0:
-            await message.answer("Сумма должна быть положительной.", reply_markup=get_cancel_keyboard(True))
-            return
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute("SELECT id FROM escorts WHERE telegram_id = ?", (telegram_id,))
-            escort = await cursor.fetchone()
-            if not escort:
-                await message.answer(f"Пользователь с Telegram ID {telegram_id} не найден.", reply_markup=get_cancel_keyboard(True))
-                return
-            await conn.execute("UPDATE escorts SET balance = balance + ? WHERE telegram_id = ?", (amount, telegram_id))
-            await conn.commit()
-            await message.answer(f"Начислено {amount:.2f} руб. пользователю ID {telegram_id}", reply_markup=get_balances_keyboard())
-            await log_action("add_balance", user_id, None, f"Начислено {amount:.2f} руб. пользователю ID {telegram_id}")
-            await state.clear()
-    except ValueError:
-        await message.answer(MESSAGES["invalid_format"] + "\nПример: 123456789, 1000", reply_markup=get_cancel_keyboard(True))
-    except aiosqlite.Error as e:
-        logger.error(f"Ошибка базы данных в process_balance_amount для {user_id}: {e}")
-        await message.answer("Ошибка базы данных.", reply_markup=get_balances_keyboard())
-        await state.clear()
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в process_balance_amount для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_balances_keyboard())
-        await state.clear()
+    telegram_id, sep, amount_str = message.text.partition(",")
+    if not sep:
+        await message.answer(MESSAGES["invalid_format"] + "\nПример: 123456789, 1000", reply_markup=CANCEL_KB)
+        return
+    telegram_id = int(telegram_id)
+    amount = float(amount_str)
+    if amount < 0:
+        await message.answer("Сумма должна быть положительной.", reply_markup=CANCEL_KB)
+        return
+    async with db_write():
+        cursor = await db.execute(
+            "UPDATE escorts SET balance = balance + ? WHERE telegram_id = ? RETURNING id", (amount, telegram_id)
+        )
+        escort = await cursor.fetchone()
+        _profit_cache.pop(telegram_id, None)
+    if not escort:
+        await message.answer(f"Пользователь с Telegram ID {telegram_id} не найден.", reply_markup=CANCEL_KB)
+        return
+    await message.answer(f"Начислено {amount:.2f} руб. пользователю ID {telegram_id}", reply_markup=BALANCES_KB)
+    log_action("add_balance", user_id, None, f"Начислено {amount:.2f} руб. пользователю ID {telegram_id}")
+    await state.clear()
 
 # Обработчик обнуления баланса
-@dp.message(lambda message: message.text == "Обнулить баланс")
+@dp.message(F.text == "Обнулить баланс")
+@admin_handler(BALANCES_KB)
 async def zero_balance(message: types.Message, state: FSMContext):
-    user_id = message.from_user.id
-    if not is_admin(user_id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(user_id))
-        return
-    try:
-        await message.answer("Введите Telegram ID пользователя для обнуления баланса:", reply_markup=get_cancel_keyboard(True))
-        await state.set_state(Form.zero_balance)
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в zero_balance для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_balances_keyboard())
+    await message.answer("Введите Telegram ID пользователя для обнуления баланса:", reply_markup=CANCEL_KB)
+    await state.set_state(Form.zero_balance)
 
 @dp.message(Form.zero_balance)
+@admin_handler(BALANCES_KB)
 async def process_zero_balance(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     if message.text == "Отмена":
-        await message.answer(MESSAGES["cancel_action"], reply_markup=get_balances_keyboard())
+        await message.answer(MESSAGES["cancel_action"], reply_markup=BALANCES_KB)
         await state.clear()
         return
-    try:
-        telegram_id = int(message.text.strip())
-        if telegram_id == user_id:
-            await message.answer("Нельзя обнулить свой баланс!", reply_markup=get_cancel_keyboard(True))
-            return
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute("SELECT username FROM escorts WHERE telegram_id = ?", (telegram_id,))
-            user = await cursor.fetchone()
-            if not user:
-                await message.answer(f"Пользователь с Telegram ID {telegram_id} не найден.", reply_markup=get_cancel_keyboard(True))
-                return
-            await conn.execute("UPDATE escorts SET balance = 0 WHERE telegram_id = ?", (telegram_id,))
-            await conn.commit()
-            await message.answer(MESSAGES["balance_zeroed"].format(user_id=telegram_id), reply_markup=get_balances_keyboard())
-            await log_action("zero_balance", user_id, None, f"Обнулён баланс пользователя ID {telegram_id}")
-            await safe_send_message(telegram_id, "Ваш баланс обнулён администратором.")
-            await state.clear()
-    except ValueError:
-        await message.answer("Неверный формат Telegram ID.", reply_markup=get_cancel_keyboard(True))
-    except aiosqlite.Error as e:
-        logger.error(f"Ошибка базы данных в process_zero_balance для {user_id}: {e}")
-        await message.answer("Ошибка базы данных.", reply_markup=get_balances_keyboard())
-        await state.clear()
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в process_zero_balance для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_balances_keyboard())
-        await state.clear()
+    telegram_id = parse_telegram_id(message.text)
+    if telegram_id is None:
+        await message.answer("Неверный формат Telegram ID.", reply_markup=CANCEL_KB)
+        return
+    if telegram_id == user_id:
+        await message.answer("Нельзя обнулить свой баланс!", reply_markup=CANCEL_KB)
+        return
+    async with db_write():
+        cursor = await db.execute("UPDATE escorts SET balance = 0 WHERE telegram_id = ? RETURNING id", (telegram_id,))
+        escort = await cursor.fetchone()
+        _profit_cache.pop(telegram_id, None)
+    if not escort:
+        await message.answer(f"Пользователь с Telegram ID {telegram_id} не найден.", reply_markup=CANCEL_KB)
+        return
+    await message.answer(MESSAGES["balance_zeroed"](user_id=telegram_id), reply_markup=BALANCES_KB)
+    log_action("zero_balance", user_id, None, f"Обнулён баланс пользователя ID {telegram_id}")
+    queue_notification(telegram_id, "Ваш баланс обнулён администратором.")
+    await state.clear()
 
 # Обработчик бана навсегда
-@dp.message(lambda message: message.text == "Бан навсегда")
+@dp.message(F.text == "Бан навсегда")
+@admin_handler(BAN_RESTRICT_KB)
 async def ban_permanent(message: types.Message, state: FSMContext):
-    user_id = message.from_user.id
-    if not is_admin(user_id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(user_id))
-        return
-    try:
-        await message.answer("Введите Telegram ID пользователя для перманентного бана:", reply_markup=get_cancel_keyboard(True))
-        await state.set_state(Form.ban_permanent)
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в ban_permanent для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_ban_restrict_keyboard())
+    await message.answer("Введите Telegram ID пользователя для перманентного бана:", reply_markup=CANCEL_KB)
+    await state.set_state(Form.ban_permanent)
 
 @dp.message(Form.ban_permanent)
+@admin_handler(BAN_RESTRICT_KB)
 async def process_ban_permanent(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     if message.text == "Отмена":
-        await message.answer(MESSAGES["cancel_action"], reply_markup=get_ban_restrict_keyboard())
+        await message.answer(MESSAGES["cancel_action"], reply_markup=BAN_RESTRICT_KB)
         await state.clear()
         return
-    try:
-        telegram_id = int(message.text.strip())
-        if telegram_id == user_id:
-            await message.answer("Нельзя забанить самого себя!", reply_markup=get_cancel_keyboard(True))
-            return
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute("SELECT username FROM escorts WHERE telegram_id = ?", (telegram_id,))
-            user = await cursor.fetchone()
-            if not user:
-                await message.answer(f"Пользователь с Telegram ID {telegram_id} не найден.", reply_markup=get_cancel_keyboard(True))
-                return
-            username = user[0]
-            await conn.execute("UPDATE escorts SET is_banned = 1, ban_until = NULL WHERE telegram_id = ?", (telegram_id,))
-            await conn.commit()
-            await message.answer(f"Пользователь {username} заблокирован навсегда.", reply_markup=get_ban_restrict_keyboard())
-            await log_action("ban_permanent", user_id, None, f"Забанен пользователь {username} ID: {telegram_id} навсегда")
-            await safe_send_message(telegram_id, MESSAGES["user_banned"])
-            await state.clear()
-    except ValueError:
-        await message.answer("Неверный формат Telegram ID.", reply_markup=get_cancel_keyboard(True))
-    except aiosqlite.Error as e:
-        logger.error(f"Ошибка базы данных в process_ban_permanent для {user_id}: {e}")
-        await message.answer("Ошибка базы данных.", reply_markup=get_ban_restrict_keyboard())
-        await state.clear()
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в process_ban_permanent для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_ban_restrict_keyboard())
-        await state.clear()
+    telegram_id = parse_telegram_id(message.text)
+    if telegram_id is None:
+        await message.answer("Неверный формат Telegram ID.", reply_markup=CANCEL_KB)
+        return
+    if telegram_id == user_id:
+        await message.answer("Нельзя забанить самого себя!", reply_markup=CANCEL_KB)
+        return
+    async with db_write():
+        cursor = await db.execute(
+            "UPDATE escorts SET is_banned = 1, ban_until = NULL WHERE telegram_id = ? "
+            "RETURNING username, is_banned, ban_until, restrict_until",
+            (telegram_id,)
+        )
+        row = await cursor.fetchone()
+    if row is None:
+        await message.answer(f"Пользователь с Telegram ID {telegram_id} не найден.", reply_markup=CANCEL_KB)
+        return
+    username = USERNAME_CACHE[telegram_id] = row[0] or "Unknown"
+    _access_status[telegram_id] = tuple(row[1:])
+    await message.answer(f"Пользователь {username} заблокирован навсегда.", reply_markup=BAN_RESTRICT_KB)
+    log_action("ban_permanent", user_id, None, f"Забанен пользователь {username} ID: {telegram_id} навсегда")
+    queue_notification(telegram_id, MESSAGES["user_banned"])
+    await state.clear()
 
 # Обработчик бана на время
-@dp.message(lambda message: message.text == "Бан на время")
+@dp.message(F.text == "Бан на время")
+@admin_handler(BAN_RESTRICT_KB)
 async def ban_duration(message: types.Message, state: FSMContext):
-    user_id = message.from_user.id
-    if not is_admin(user_id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(user_id))
-        return
-    try:
-        await message.answer("Введите Telegram ID и длительность бана в днях (через запятую):", reply_markup=get_cancel_keyboard(True))
-        await state.set_state(Form.ban_duration)
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в ban_duration для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_ban_restrict_keyboard())
+    await message.answer("Введите Telegram ID и длительность бана в днях (через запятую):", reply_markup=CANCEL_KB)
+    await state.set_state(Form.ban_duration)
 
 @dp.message(Form.ban_duration)
+@admin_handler(BAN_RESTRICT_KB, invalid_input=MESSAGES["invalid_format"] + "\nПример: 123456789, 7")
 async def process_ban_duration(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     if message.text == "Отмена":
-        await message.answer(MESSAGES["cancel_action"], reply_markup=get_ban_restrict_keyboard())
+        await message.answer(MESSAGES["cancel_action"], reply_markup=BAN_RESTRICT_KB)
         await state.clear()
         return
-    try:
-        parts = [x.strip() for x in message.text.split(", ", 1)]
-        if len(parts) != 2:
-            await message.answer(MESSAGES["invalid_format"] + "\nПример: 123456789, 7", reply_markup=get_cancel_keyboard(True))
-            return
-        telegram_id, days_str = parts
-        telegram_id = int(telegram_id)
-        days = int(days_str)
-        if telegram_id == user_id:
-            await message.answer("Нельзя забанить самого себя!", reply_markup=get_cancel_keyboard(True))
-            return
-        if days <= 0:
-            await message.answer("Длительность бана должна быть положительной.", reply_markup=get_cancel_keyboard(True))
-            return
-        ban_until = (datetime.now() + timedelta(days=days)).isoformat()
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute("SELECT username FROM escorts WHERE telegram_id = ?", (telegram_id,))
-            user = await cursor.fetchone()
-            if not user:
-                await message.answer(f"Пользователь с Telegram ID {telegram_id} не найден.", reply_markup=get_cancel_keyboard(True))
-                return
-            username = user[0]
-            await conn.execute("UPDATE escorts SET is_banned = 1, ban_until = ? WHERE telegram_id = ?", (ban_until, telegram_id))
-            await conn.commit()
-            formatted_date = datetime.fromisoformat(ban_until).strftime("%d.%m.%Y %H:%M")
-            await message.answer(f"Пользователь {username} заблокирован до {formatted_date}", reply_markup=get_ban_restrict_keyboard())
-            await log_action("ban_duration", user_id, None, f"Забанен пользователь {username} ID: {telegram_id} до {formatted_date}")
-            await safe_send_message(telegram_id, MESSAGES["user_restricted"].format(date=formatted_date))
-            await state.clear()
-    except ValueError:
-        await message.answer(MESSAGES["invalid_format"] + "\nПример: 123456789, 7", reply_markup=get_cancel_keyboard(True))
-    except aiosqlite.Error as e:
-        logger.error(f"Ошибка базы данных в process_ban_duration для {user_id}: {e}")
-        await message.answer("Ошибка базы данных.", reply_markup=get_ban_restrict_keyboard())
-        await state.clear()
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в process_ban_duration для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_ban_restrict_keyboard())
-        await state.clear()
+    telegram_id, sep, days_str = message.text.partition(",")
+    if not sep:
+        await message.answer(MESSAGES["invalid_format"] + "\nПример: 123456789, 7", reply_markup=CANCEL_KB)
+        return
+    telegram_id = int(telegram_id)
+    days = int(days_str)
+    if telegram_id == user_id:
+        await message.answer("Нельзя забанить самого себя!", reply_markup=CANCEL_KB)
+        return
+    if not 0 < days <= MAX_PENALTY_DAYS:
+        await message.answer(f"Длительность бана должна быть от 1 до {MAX_PENALTY_DAYS} дней.", reply_markup=CANCEL_KB)
+        return
+    ban_until = int(time.time()) + days * 86400
+    formatted_date = datetime.fromtimestamp(ban_until).strftime("%d.%m.%Y %H:%M")
+    async with db_write():
+        cursor = await db.execute(
+            "UPDATE escorts SET is_banned = 1, ban_until = ? WHERE telegram_id = ? "
+            "RETURNING username, is_banned, ban_until, restrict_until",
+            (ban_until, telegram_id)
+        )
+        row = await cursor.fetchone()
+    if row is None:
+        await message.answer(f"Пользователь с Telegram ID {telegram_id} не найден.", reply_markup=CANCEL_KB)
+        return
+    username = USERNAME_CACHE[telegram_id] = row[0] or "Unknown"
+    _access_status[telegram_id] = tuple(row[1:])
+    await message.answer(f"Пользователь {username} заблокирован до {formatted_date}", reply_markup=BAN_RESTRICT_KB)
+    log_action("ban_duration", user_id, None, f"Забанен пользователь {username} ID: {telegram_id} до {formatted_date}")
+    queue_notification(telegram_id, MESSAGES["user_restricted"](date=formatted_date))
+    await state.clear()
 
 # Обработчик ограничения
-@dp.message(lambda message: message.text == "Ограничить")
+@dp.message(F.text == "Ограничить")
+@admin_handler(BAN_RESTRICT_KB)
 async def restrict_user(message: types.Message, state: FSMContext):
-    user_id = message.from_user.id
-    if not is_admin(user_id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(user_id))
-        return
-    try:
-        await message.answer("Введите Telegram ID и длительность ограничения в днях (через запятую):", reply_markup=get_cancel_keyboard(True))
-        await state.set_state(Form.restrict_duration)
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в restrict_user для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_ban_restrict_keyboard())
+    await message.answer("Введите Telegram ID и длительность ограничения в днях (через запятую):", reply_markup=CANCEL_KB)
+    await state.set_state(Form.restrict_duration)
 
 @dp.message(Form.restrict_duration)
+@admin_handler(BAN_RESTRICT_KB, invalid_input=MESSAGES["invalid_format"] + "\nПример: 123456789, 7")
 async def process_restrict_duration(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     if message.text == "Отмена":
-        await message.answer(MESSAGES["cancel_action"], reply_markup=get_ban_restrict_keyboard())
+        await message.answer(MESSAGES["cancel_action"], reply_markup=BAN_RESTRICT_KB)
         await state.clear()
         return
-    try:
-        parts = [x.strip() for x in message.text.split(", ", 1)]
-        if len(parts) != 2:
-            await message.answer(MESSAGES["invalid_format"] + "\nПример: 123456789, 7", reply_markup=get_cancel_keyboard(True))
-            return
-        telegram_id, days_str = parts
-        telegram_id = int(telegram_id)
-        days = int(days_str)
-        if telegram_id == user_id:
-            await message.answer("Нельзя ограничить самого себя!", reply_markup=get_cancel_keyboard(True))
-            return
-        if days <= 0:
-            await message.answer("Длительность ограничения должна быть положительной.", reply_markup=get_cancel_keyboard(True))
-            return
-        restrict_until = (datetime.now() + timedelta(days=days)).isoformat()
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute("SELECT username FROM escorts WHERE telegram_id = ?", (telegram_id,))
-            user = await cursor.fetchone()
-            if not user:
-                await message.answer(f"Пользователь с Telegram ID {telegram_id} не найден.", reply_markup=get_cancel_keyboard(True))
-                return
-            username = user[0]
-            await conn.execute("UPDATE escorts SET restrict_until = ? WHERE telegram_id = ?", (restrict_until, telegram_id))
-            await conn.commit()
-            formatted_date = datetime.fromisoformat(restrict_until).strftime("%d.%m.%Y %H:%M")
-            await message.answer(f"Пользователь {username} ограничен до {formatted_date}", reply_markup=get_ban_restrict_keyboard())
-            await log_action("restrict_user", user_id, None, f"Ограничен пользователь {username} ID: {telegram_id} до {formatted_date}")
-            await safe_send_message(telegram_id, MESSAGES["user_restricted"].format(date=formatted_date))
-            await state.clear()
-    except ValueError:
-        await message.answer(MESSAGES["invalid_format"] + "\nПример: 123456789, 7", reply_markup=get_cancel_keyboard(True))
-    except aiosqlite.Error as e:
-        logger.error(f"Ошибка базы данных в process_restrict_duration для {user_id}: {e}")
-        await message.answer("Ошибка базы данных.", reply_markup=get_ban_restrict_keyboard())
-        await state.clear()
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в process_restrict_duration для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_ban_restrict_keyboard())
-        await state.clear()
+    telegram_id, sep, days_str = message.text.partition(",")
+    if not sep:
+        await message.answer(MESSAGES["invalid_format"] + "\nПример: 123456789, 7", reply_markup=CANCEL_KB)
+        return
+    telegram_id = int(telegram_id)
+    days = int(days_str)
+    if telegram_id == user_id:
+        await message.answer("Нельзя ограничить самого себя!", reply_markup=CANCEL_KB)
+        return
+    if not 0 < days <= MAX_PENALTY_DAYS:
+        await message.answer(f"Длительность ограничения должна быть от 1 до {MAX_PENALTY_DAYS} дней.", reply_markup=CANCEL_KB)
+        return
+    restrict_until = int(time.time()) + days * 86400
+    formatted_date = datetime.fromtimestamp(restrict_until).strftime("%d.%m.%Y %H:%M")
+    async with db_write():
+        cursor = await db.execute(
+            "UPDATE escorts SET restrict_until = ? WHERE telegram_id = ? "
+            "RETURNING username, is_banned, ban_until, restrict_until",
+            (restrict_until, telegram_id)
+        )
+        row = await cursor.fetchone()
+    if row is None:
+        await message.answer(f"Пользователь с Telegram ID {telegram_id} не найден.", reply_markup=CANCEL_KB)
+        return
+    username = USERNAME_CACHE[telegram_id] = row[0] or "Unknown"
+    _access_status[telegram_id] = tuple(row[1:])
+    await message.answer(f"Пользователь {username} ограничен до {formatted_date}", reply_markup=BAN_RESTRICT_KB)
+    log_action("restrict_user", user_id, None, f"Ограничен пользователь {username} ID: {telegram_id} до {formatted_date}")
+    queue_notification(telegram_id, MESSAGES["user_restricted"](date=formatted_date))
+    await state.clear()
 
 # Обработчик снятия бана
-@dp.message(lambda message: message.text == "Снять бан")
+@dp.message(F.text == "Снять бан")
+@admin_handler(BAN_RESTRICT_KB)
 async def unban_user(message: types.Message, state: FSMContext):
-    user_id = message.from_user.id
-    if not is_admin(user_id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(user_id))
-        return
-    try:
-        await message.answer("Введите Telegram ID пользователя для снятия бана:", reply_markup=get_cancel_keyboard(True))
-        await state.set_state(Form.unban_user)
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в unban_user для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_ban_restrict_keyboard())
+    await message.answer("Введите Telegram ID пользователя для снятия бана:", reply_markup=CANCEL_KB)
+    await state.set_state(Form.unban_user)
 
 @dp.message(Form.unban_user)
+@admin_handler(BAN_RESTRICT_KB)
 async def process_unban_user(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     if message.text == "Отмена":
-        await message.answer(MESSAGES["cancel_action"], reply_markup=get_ban_restrict_keyboard())
+        await message.answer(MESSAGES["cancel_action"], reply_markup=BAN_RESTRICT_KB)
         await state.clear()
         return
-    try:
-        telegram_id = int(message.text.strip())
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute("SELECT username FROM escorts WHERE telegram_id = ?", (telegram_id,))
-            user = await cursor.fetchone()
-            if not user:
-                await message.answer(f"Пользователь с Telegram ID {telegram_id} не найден.", reply_markup=get_cancel_keyboard(True))
-                return
-            username = user[0]
-            await conn.execute("UPDATE escorts SET is_banned = 0, ban_until = NULL WHERE telegram_id = ?", (telegram_id,))
-            await conn.commit()
-            await message.answer(MESSAGES["user_unbanned"].format(username=username), reply_markup=get_ban_restrict_keyboard())
-            await log_action("unban_user", user_id, None, f"Снят бан с пользователя {username} ID: {telegram_id}")
-            await safe_send_message(telegram_id, "Бан снят. Вы снова можете использовать бота.")
-            await state.clear()
-    except ValueError:
-        await message.answer("Неверный формат Telegram ID.", reply_markup=get_cancel_keyboard(True))
-    except aiosqlite.Error as e:
-        logger.error(f"Ошибка базы данных в process_unban_user для {user_id}: {e}")
-        await message.answer("Ошибка базы данных.", reply_markup=get_ban_restrict_keyboard())
-        await state.clear()
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в process_unban_user для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_ban_restrict_keyboard())
-        await state.clear()
+    telegram_id = parse_telegram_id(message.text)
+    if telegram_id is None:
+        await message.answer("Неверный формат Telegram ID.", reply_markup=CANCEL_KB)
+        return
+    async with db_write():
+        cursor = await db.execute(
+            "UPDATE escorts SET is_banned = 0, ban_until = NULL WHERE telegram_id = ? "
+            "RETURNING username, is_banned, ban_until, restrict_until",
+            (telegram_id,)
+        )
+        row = await cursor.fetchone()
+    if row is None:
+        await message.answer(f"Пользователь с Telegram ID {telegram_id} не найден.", reply_markup=CANCEL_KB)
+        return
+    username = USERNAME_CACHE[telegram_id] = row[0] or "Unknown"
+    _access_status[telegram_id] = tuple(row[1:])
+    await message.answer(MESSAGES["user_unbanned"](username=username), reply_markup=BAN_RESTRICT_KB)
+    log_action("unban_user", user_id, None, f"Снят бан с пользователя {username} ID: {telegram_id}")
+    queue_notification(telegram_id, "Бан снят. Вы снова можете использовать бота.")
+    await state.clear()
 
 # Обработчик снятия ограничения
-@dp.message(lambda message: message.text == "Снять ограничение")
+@dp.message(F.text == "Снять ограничение")
+@admin_handler(BAN_RESTRICT_KB)
 async def unrestrict_user(message: types.Message, state: FSMContext):
-    user_id = message.from_user.id
-    if not is_admin(user_id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(user_id))
-        return
-    try:
-        await message.answer("Введите Telegram ID пользователя для снятия ограничения:", reply_markup=get_cancel_keyboard(True))
-        await state.set_state(Form.unrestrict_user)
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в unrestrict_user для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_ban_restrict_keyboard())
+    await message.answer("Введите Telegram ID пользователя для снятия ограничения:", reply_markup=CANCEL_KB)
+    await state.set_state(Form.unrestrict_user)
 
 @dp.message(Form.unrestrict_user)
+@admin_handler(BAN_RESTRICT_KB)
 async def process_unrestrict_user(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     if message.text == "Отмена":
-        await message.answer(MESSAGES["cancel_action"], reply_markup=get_ban_restrict_keyboard())
+        await message.answer(MESSAGES["cancel_action"], reply_markup=BAN_RESTRICT_KB)
         await state.clear()
         return
-    try:
-        telegram_id = int(message.text.strip())
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute("SELECT username FROM escorts WHERE telegram_id = ?", (telegram_id,))
-            user = await cursor.fetchone()
-            if not user:
-                await message.answer(f"Пользователь с Telegram ID {telegram_id} не найден.", reply_markup=get_cancel_keyboard(True))
-                return
-            username = user[0]
-            await conn.execute("UPDATE escorts SET restrict_until = NULL WHERE telegram_id = ?", (telegram_id,))
-            await conn.commit()
-            await message.answer(MESSAGES["user_unrestricted"].format(username=username), reply_markup=get_ban_restrict_keyboard())
-            await log_action("unrestrict_user", user_id, None, f"Снято ограничение с пользователя {username} ID: {telegram_id}")
-            await safe_send_message(telegram_id, "Ограничения с вас сняты. Вы снова можете использовать бота.")
-            await state.clear()
-    except ValueError:
-        await message.answer("Неверный формат Telegram ID.", reply_markup=get_cancel_keyboard(True))
-    except aiosqlite.Error as e:
-        logger.error(f"Ошибка базы данных в process_unrestrict_user для {user_id}: {e}")
-        await message.answer("Ошибка базы данных.", reply_markup=get_ban_restrict_keyboard())
-        await state.clear()
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в process_unrestrict_user для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_ban_restrict_keyboard())
-        await state.clear()
+    telegram_id = parse_telegram_id(message.text)
+    if telegram_id is None:
+        await message.answer("Неверный формат Telegram ID.", reply_markup=CANCEL_KB)
+        return
+    async with db_write():
+        cursor = await db.execute(
+            "UPDATE escorts SET restrict_until = NULL WHERE telegram_id = ? "
+            "RETURNING username, is_banned, ban_until, restrict_until",
+            (telegram_id,)
+        )
+        row = await cursor.fetchone()
+    if row is None:
+        await message.answer(f"Пользователь с Telegram ID {telegram_id} не найден.", reply_markup=CANCEL_KB)
+        return
+    username = USERNAME_CACHE[telegram_id] = row[0] or "Unknown"
+    _access_status[telegram_id] = tuple(row[1:])
+    await message.answer(MESSAGES["user_unrestricted"](username=username), reply_markup=BAN_RESTRICT_KB)
+    log_action("unrestrict_user", user_id, None, f"Снято ограничение с пользователя {username} ID: {telegram_id}")
+    queue_notification(telegram_id, "Ограничения с вас сняты. Вы снова можете использовать бота.")
+    await state.clear()
 
 # Обработчик списка балансов
-@dp.message(lambda message: message.text == "Баланс сопровождающих")
+@dp.message(F.text == "Баланс сопровождающих")
+@admin_handler(BALANCES_KB)
 async def list_balances(message: types.Message, state: FSMContext):
-    user_id = message.from_user.id
-    if not is_admin(user_id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(user_id))
+    escorts = await db.execute_fetchall("SELECT telegram_id, username, balance FROM escorts")
+    if not escorts:
+        await message.answer("Нет зарегистрированных сопровождающих.", reply_markup=BALANCES_KB)
         return
-    try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute("SELECT telegram_id, username, balance FROM escorts")
-            escorts = await cursor.fetchall()
-            if not escorts:
-                await message.answer("Нет зарегистрированных сопровождающих.", reply_markup=get_balances_keyboard())
-                return
-            response = "Баланс сопровождающих:\n"
-            for telegram_id, username, balance in escorts:
-                response += f"{username} (ID: {telegram_id}): {balance:.2f} руб.\n"
-            await message.answer(response, reply_markup=get_balances_keyboard())
-    except aiosqlite.Error as e:
-        logger.error(f"Ошибка базы данных в list_balances для {user_id}: {e}")
-        await message.answer("Ошибка базы данных.", reply_markup=get_balances_keyboard())
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в list_balances для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_balances_keyboard())
+    parts = ["Баланс сопровождающих:"]
+    parts.extend(f"{username} (ID: {telegram_id}): {balance:.2f} руб." for telegram_id, username, balance in escorts)
+    await answer_chunked(message, parts, reply_markup=BALANCES_KB)
 
 # Обработчик отчета за месяц
-@dp.message(lambda message: message.text == "Отчет за месяц")
+@dp.message(F.text == "Отчет за месяц")
+@admin_handler(REPORTS_KB)
 async def monthly_report(message: types.Message, state: FSMContext):
-    user_id = message.from_user.id
-    if not is_admin(user_id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(user_id))
-        return
-    try:
-        start_date = (datetime.now() - timedelta(days=30)).isoformat()
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute(
-                "SELECT COUNT(*) as order_count, SUM(amount) as total_amount FROM orders WHERE created_at >= ?",
-                (start_date,)
-            )
-            order_count, total_amount = await cursor.fetchone()
-            total_amount = total_amount or 0
-            response = (
-                f"Отчет за последние 30 дней:\n"
-                f"Заказов: {order_count}\n"
-                f"Общая сумма: {total_amount:.2f} руб.\n"
-            )
-            await message.answer(response, reply_markup=get_reports_keyboard())
-    except aiosqlite.Error as e:
-        logger.error(f"Ошибка базы данных в monthly_report для {user_id}: {e}")
-        await message.answer("Ошибка базы данных.", reply_markup=get_reports_keyboard())
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в monthly_report для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_reports_keyboard())
+    start_date = report_start_date()
+    [(order_count, total_amount)] = await db.execute_fetchall(
+        "SELECT COUNT(*) as order_count, SUM(amount) as total_amount FROM orders WHERE created_at >= ?",
+        (start_date,)
+    )
+    total_amount = total_amount or 0
+    response = (
+        f"Отчет за последние 30 дней:\n"
+        f"Заказов: {order_count}\n"
+        f"Общая сумма: {total_amount:.2f} руб.\n"
+    )
+    await message.answer(response, reply_markup=REPORTS_KB)
 
 # Обработчик экспорта данных
-@dp.message(lambda message: message.text == "Экспорт данных")
+@dp.message(F.text == "Экспорт данных")
+@admin_handler(REPORTS_KB)
 async def export_data(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    if not is_admin(user_id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(user_id))
+    filename = await asyncio.to_thread(export_orders_to_csv)
+    if not filename:
+        await message.answer(MESSAGES["no_data_to_export"], reply_markup=REPORTS_KB)
         return
+    # Файл удаляется и при ошибке отправки; удаление — вне цикла событий
     try:
-        filename = await export_orders_to_csv()
-        if not filename:
-            await message.answer(MESSAGES["no_data_to_export"], reply_markup=get_reports_keyboard())
-            return
-        await message.answer(MESSAGES["export_success"].format(filename=filename), reply_markup=get_reports_keyboard())
+        await message.answer(MESSAGES["export_success"](filename=filename), reply_markup=REPORTS_KB)
         await bot.send_document(user_id, FSInputFile(filename))
-        await log_action("export_data", user_id, None, f"Экспортированы данные в {filename}")
-        os.remove(filename)
-    except (aiosqlite.Error, OSError) as e:
-        logger.error(f"Ошибка экспорта данных для {user_id}: {e}")
-        await message.answer("Ошибка экспорта данных.", reply_markup=get_reports_keyboard())
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в export_data для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_reports_keyboard())
+        log_action("export_data", user_id, None, f"Экспортированы данные в {filename}")
+    except OSError as e:
+        logger.error("Ошибка экспорта данных для %s: %s", user_id, e)
+        await message.answer("Ошибка экспорта данных.", reply_markup=REPORTS_KB)
+    finally:
+        await asyncio.to_thread(os.remove, filename)
+
+# Журнал длиннее этого порога отправляется файлом
+REPORT_DOCUMENT_THRESHOLD = 3500
 
 # Обработчик журнала действий
-@dp.message(lambda message: message.text == "Журнал действий")
+@dp.message(F.text == "Журнал действий")
+@admin_handler(REPORTS_KB)
 async def action_log(message: types.Message, state: FSMContext):
-    user_id = message.from_user.id
-    if not is_admin(user_id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(user_id))
+    rows = await db.execute_fetchall(
+        "SELECT action_type, user_id, order_id, description, action_date FROM action_log ORDER BY action_date DESC LIMIT 50"
+    )
+    parts = ["Журнал действий (последние 50):"]
+    for action_type, action_user_id, order_id, description, action_date in rows:
+        formatted_date = format_date(action_date)
+        parts.append(f"[{formatted_date}] {action_type} (ID: {action_user_id}, Заказ: {order_id or 'N/A'}): {description}")
+    if len(parts) == 1:
+        await message.answer("Журнал действий пуст.", reply_markup=REPORTS_KB)
         return
-    try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute(
-                "SELECT action_type, user_id, order_id, description, action_date FROM action_log ORDER BY action_date DESC LIMIT 50"
-            )
-            actions = await cursor.fetchall()
-            if not actions:
-                await message.answer("Журнал действий пуст.", reply_markup=get_reports_keyboard())
-                return
-            response = "Журнал действий (последние 50):\n"
-            for action_type, action_user_id, order_id, description, action_date in actions:
-                formatted_date = datetime.fromisoformat(action_date).strftime("%d.%m.%Y")
-                response += f"[{formatted_date}] {action_type} (ID: {action_user_id}, Заказ: {order_id or 'N/A'}): {description}\n"
-            await message.answer(response, reply_markup=get_reports_keyboard())
-    except aiosqlite.Error as e:
-        logger.error(f"Ошибка базы данных в action_log для {user_id}: {e}")
-        await message.answer("Ошибка базы данных.", reply_markup=get_reports_keyboard())
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в action_log для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_reports_keyboard())
+    body = "\n".join(parts)
+    if len(body) > REPORT_DOCUMENT_THRESHOLD:
+        await message.answer_document(
+            BufferedInputFile(body.encode("utf-8"), filename="action_log.txt"), reply_markup=REPORTS_KB
+        )
+    else:
+        await message.answer(body, reply_markup=REPORTS_KB)
+
+# Кэш отчетов о доходе: telegram_id -> (время, username, текст отчета)
+PROFIT_CACHE_TTL = 60
+_profit_cache: dict[int, tuple[float, str, str]] = {}
 
 # Обработчик дохода пользователя
-@dp.message(lambda message: message.text == "Доход пользователей")
+@dp.message(F.text == "Доход пользователей")
+@admin_handler(REPORTS_KB)
 async def user_profit(message: types.Message, state: FSMContext):
-    user_id = message.from_user.id
-    if not is_admin(user_id):
-        await message.answer(MESSAGES["no_access"], reply_markup=get_menu_keyboard(user_id))
-        return
-    try:
-        await message.answer("Введите Telegram ID пользователя для отчета о доходе:", reply_markup=get_cancel_keyboard(True))
-        await state.set_state(Form.profit_user)
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в user_profit для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_reports_keyboard())
+    await message.answer("Введите Telegram ID пользователя для отчета о доходе:", reply_markup=CANCEL_KB)
+    await state.set_state(Form.profit_user)
 
 @dp.message(Form.profit_user)
+@admin_handler(REPORTS_KB)
 async def process_user_profit(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     if message.text == "Отмена":
-        await message.answer(MESSAGES["cancel_action"], reply_markup=get_reports_keyboard())
+        await message.answer(MESSAGES["cancel_action"], reply_markup=REPORTS_KB)
         await state.clear()
         return
-    try:
-        telegram_id = int(message.text.strip())
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute("SELECT username, balance, completed_orders FROM escorts WHERE telegram_id = ?", (telegram_id,))
-            user = await cursor.fetchone()
-            if not user:
-                await message.answer(f"Пользователь с Telegram ID {telegram_id} не найден.", reply_markup=get_cancel_keyboard(True))
-                return
-            username, balance, completed_orders = user
-            start_date = (datetime.now() - timedelta(days=30)).isoformat()
-            cursor = await conn.execute(
-                "SELECT COUNT(*) as order_count, SUM(amount) as total_amount FROM orders WHERE escort_id = ? AND created_at >= ? AND status = 'completed'",
-                (telegram_id, start_date)
-            )
-            order_data = await cursor.fetchone()
-            order_count, total_amount = order_data
-            total_amount = total_amount or 0
-            cursor = await conn.execute(
-                "SELECT SUM(amount) as total_payout FROM payouts WHERE user_id = ? AND payout_date >= ?",
-                (telegram_id, start_date)
-            )
-            total_payout = (await cursor.fetchone())[0] or 0
-            response = (
-                f"Доход пользователя {username} (ID: {telegram_id}):\n"
-                f"Текущий баланс: {balance:.2f} руб.\n"
-                f"Завершённых заказов за месяц: {order_count}\n"
-                f"Сумма заказов за месяц: {total_amount:.2f} руб.\n"
-                f"Выплачено за месяц: {total_payout:.2f} руб.\n"
-            )
-            await message.answer(response, reply_markup=get_reports_keyboard())
-            await log_action("view_user_profit", user_id, None, f"Просмотрен доход пользователя {username} ID: {telegram_id}")
-            await state.clear()
-    except ValueError:
-        await message.answer("Неверный формат Telegram ID.", reply_markup=get_cancel_keyboard(True))
-    except aiosqlite.Error as e:
-        logger.error(f"Ошибка базы данных в process_user_profit для {user_id}: {e}")
-        await message.answer("Ошибка базы данных.", reply_markup=get_reports_keyboard())
-        await state.clear()
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в process_user_profit для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_reports_keyboard())
+    telegram_id = parse_telegram_id(message.text)
+    if telegram_id is None:
+        await message.answer("Неверный формат Telegram ID.", reply_markup=CANCEL_KB)
+        return
+    ts, username, response = _profit_cache.get(telegram_id, (0.0, None, None))
+    if time.monotonic() - ts < PROFIT_CACHE_TTL:
+        await message.answer(response, reply_markup=REPORTS_KB)
+        log_action("view_user_profit", user_id, None, f"Просмотрен доход пользователя {username} ID: {telegram_id}")
         await state.clear()
+        return
+    start_date = report_start_date()
+    # Профиль, заказы и выплаты за месяц одним запросом
+    cursor = await db.execute(
+        """
+        SELECT e.username, e.balance, e.completed_orders,
+               (SELECT COUNT(*) FROM orders o
+                JOIN order_escorts oe ON oe.order_id = o.id
+                WHERE oe.escort_id = e.id AND o.created_at >= :start AND o.status = 'completed'),
+               (SELECT COALESCE(SUM(o.amount), 0) FROM orders o
+                JOIN order_escorts oe ON oe.order_id = o.id
+                WHERE oe.escort_id = e.id AND o.created_at >= :start AND o.status = 'completed'),
+               COALESCE(SUM(p.amount), 0)
+        FROM escorts e
+        LEFT JOIN payouts p ON p.escort_id = e.id AND p.payout_date >= :start
+        WHERE e.telegram_id = :tid
+        GROUP BY e.id
+        """,
+        {"tid": telegram_id, "start": start_date}
+    )
+    user = await cursor.fetchone()
+    if not user:
+        await message.answer(f"Пользователь с Telegram ID {telegram_id} не найден.", reply_markup=CANCEL_KB)
+        return
+    username, balance, completed_orders, order_count, total_amount, total_payout = user
+    response = (
+        f"Доход пользователя {username} (ID: {telegram_id}):\n"
+        f"Текущий баланс: {balance:.2f} руб.\n"
+        f"Завершённых заказов за месяц: {order_count}\n"
+        f"Сумма заказов за месяц: {total_amount:.2f} руб.\n"
+        f"Выплачено за месяц: {total_payout:.2f} руб.\n"
+    )
+    _profit_cache[telegram_id] = (time.monotonic(), username, response)
+    await message.answer(response, reply_markup=REPORTS_KB)
+    log_action("view_user_profit", user_id, None, f"Просмотрен доход пользователя {username} ID: {telegram_id}")
+    await state.clear()
 
 # Обработчик запросов в поддержку
-@dp.message(lambda message: message.text == "Поддержка")
+@dp.message(F.text == "Поддержка")
+@user_handler
 async def support_request(message: types.Message, state: FSMContext):
-    user_id = message.from_user.id
     if not await check_access(message):
         return
-    try:
-        await message.answer(MESSAGES["support_request"], reply_markup=get_cancel_keyboard())
-        await state.set_state(Form.support_message)
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в support_request для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_menu_keyboard(user_id))
+    await message.answer(MESSAGES["support_request"], reply_markup=CANCEL_KB)
+    await state.set_state(Form.support_message)
 
 @dp.message(Form.support_message)
+@user_handler
 async def process_support_message(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     if message.text == "Отмена":
         await message.answer(MESSAGES["cancel_action"], reply_markup=get_menu_keyboard(user_id))
         await state.clear()
         return
-    try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute("SELECT username FROM escorts WHERE telegram_id = ?", (user_id,))
-            user = await cursor.fetchone()
-            username = user[0] if user else "Unknown"
-            support_text = message.text.strip()
-            if not support_text:
-                await message.answer("Запрос не может быть пустым.", reply_markup=get_cancel_keyboard())
-                return
-            await notify_admins(f"Новый запрос в поддержку от {username} (ID: {user_id}): {support_text}", reply_to_user_id=user_id)
-            await message.answer(MESSAGES["support_sent"], reply_markup=get_menu_keyboard(user_id))
-            await log_action("support_request", user_id, None, f"Отправлен запрос в поддержку: {support_text}")
-            await state.clear()
-    except aiosqlite.Error as e:
-        logger.error(f"Ошибка базы данных в process_support_message для {user_id}: {e}")
-        await message.answer("Ошибка базы данных.", reply_markup=get_menu_keyboard(user_id))
-        await state.clear()
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в process_support_message для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_menu_keyboard(user_id))
-        await state.clear()
+    username = await get_username(user_id) or "Unknown"
+    support_text = message.text.strip()
+    if not support_text:
+        await message.answer("Запрос не может быть пустым.", reply_markup=CANCEL_KB)
+        return
+    await notify_admins(f"Новый запрос в поддержку от {username} (ID: {user_id}): {support_text}", reply_to_user_id=user_id)
+    await message.answer(MESSAGES["support_sent"], reply_markup=get_menu_keyboard(user_id))
+    log_action("support_request", user_id, None, f"Отправлен запрос в поддержку: {support_text}")
+    await state.clear()
+
+# Названия статусов заказов
+STATUS_RU = {
+    "open": "Открыт",
+    "pending": "В ожидании",
+    "completed": "Завершён",
+    "cancelled": "Отменён",
+}
 
 # Обработчик команды /my_orders
 @dp.message(Command("my_orders"))
+@user_handler
 async def my_orders(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     if not await check_access(message):
         return
-    try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute(
-                "SELECT memo_order_id, customer_info, amount, status, created_at FROM orders WHERE escort_id = ? ORDER BY created_at DESC LIMIT 10",
-                (user_id,)
-            )
-            orders = await cursor.fetchall()
-            if not orders:
-                await message.answer(MESSAGES["no_orders"], reply_markup=get_menu_keyboard(user_id))
-                return
-            response = "Ваши заказы (последние 10):\n"
-            for order_id, customer, amount, status, created_at in orders:
-                formatted_date = datetime.fromisoformat(created_at).strftime("%d.%m.%Y")
-                status_text = "В ожидании" if status == "pending" else "Завершён"
-                response += (
-                    f"Заказ #{order_id}\n"
-                    f"Клиент: {customer}\n"
-                    f"Сумма: {amount:.2f} руб.\n"
-                    f"Статус: {status_text}\n"
-                    f"Дата: {formatted_date}\n\n"
-                )
-            await message.answer(response, reply_markup=get_menu_keyboard(user_id))
-    except aiosqlite.Error as e:
-        logger.error(f"Ошибка базы данных в my_orders для {user_id}: {e}")
-        await message.answer("Ошибка базы данных.", reply_markup=get_menu_keyboard(user_id))
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в my_orders для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_menu_keyboard(user_id))
+    rows = await db.execute_fetchall(
+        """
+        SELECT o.memo_order_id, o.customer_info, o.amount, o.status, o.created_at
+        FROM orders o
+        JOIN order_escorts oe ON oe.order_id = o.id
+        JOIN escorts e ON e.id = oe.escort_id
+        WHERE e.telegram_id = ?
+        ORDER BY o.created_at DESC LIMIT 10
+        """,
+        (user_id,)
+    )
+    parts = ["Ваши заказы (последние 10):\n"]
+    for order_id, customer, amount, status, created_at in rows:
+        formatted_date = format_date(created_at)
+        status_text = STATUS_RU.get(status, status)
+        parts.append(
+            f"Заказ #{order_id}\n"
+            f"Клиент: {customer}\n"
+            f"Сумма: {amount:.2f} руб.\n"
+            f"Статус: {status_text}\n"
+            f"Дата: {formatted_date}\n\n"
+        )
+    if len(parts) == 1:
+        await message.answer(MESSAGES["no_orders"], reply_markup=get_menu_keyboard(user_id))
+        return
+    await message.answer("".join(parts), reply_markup=get_menu_keyboard(user_id))
 
 # Обработчик неизвестных команд
 @dp.message()
+@user_handler
 async def unknown_command(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     if not await check_access(message):
         return
-    try:
-        await message.answer("Неизвестная команда. Используйте кнопки меню.", reply_markup=get_menu_keyboard(user_id))
-        await state.clear()
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка Telegram API в unknown_command для {user_id}: {e}")
-        await message.answer(MESSAGES["error"], reply_markup=get_menu_keyboard(user_id))
-        await state.clear()
+    await message.answer("Неизвестная команда. Используйте кнопки меню.", reply_markup=get_menu_keyboard(user_id))
+    await state.clear()
 
 # Запуск бота
+# Приём обновлений через webhook: aiohttp-сервер работает до SIGTERM/SIGINT.
+# Сигналы ловим сами (как start_polling), чтобы при docker stop отработал finally в main()
+async def run_webhook():
+    loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        with suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop_event.set)
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT).start()
+        await bot.set_webhook(
+            WEBHOOK_URL + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+        await stop_event.wait()
+        logger.info("Получен сигнал остановки, завершаем webhook-сервер")
+    finally:
+        await runner.cleanup()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            with suppress(NotImplementedError):
+                loop.remove_signal_handler(sig)
+
 async def main():
+    notify_task = asyncio.create_task(notify_worker())
+    log_task = asyncio.create_task(log_writer())
     try:
         await init_db()
-        scheduler.add_job(lambda: None, "interval", hours=24)  # Заглушка, так как check_pending_orders не определена
+        await load_access_status()
+        scheduler.add_job(optimize_db, "interval", minutes=15)
+        scheduler.add_job(checkpoint_db, "interval", minutes=30)
         scheduler.start()
         logger.info("Бот запущен")
-        await dp.start_polling(bot)
+        if WEBHOOK_URL:
+            await run_webhook()
+        else:
+            # Снимаем webhook, оставшийся от прошлого запуска, иначе getUpdates вернёт конфликт
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
     except Exception as e:
-        logger.error(f"Ошибка при запуске бота: {e}\n{traceback.format_exc()}")
+        logger.error("Ошибка при запуске бота: %s", e, exc_info=True)
         raise
+    finally:
+        # Досылаем уведомления из очереди перед остановкой
+        try:
+            await asyncio.wait_for(notify_queue.join(), NOTIFY_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Не отправлено уведомлений при остановке: %s", notify_queue.qsize())
+        notify_task.cancel()
+        # Дописываем журнал действий перед закрытием базы
+        try:
+            await asyncio.wait_for(log_queue.join(), NOTIFY_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Не записано действий в журнал при остановке: %s", log_queue.qsize())
+        log_task.cancel()
+        if scheduler.running:
+            scheduler.shutdown(wait=False)
+        await close_db()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
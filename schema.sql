@@ -38,8 +38,8 @@ CREATE TABLE IF NOT EXISTS escorts (
     rating REAL DEFAULT 0,
     rating_count INTEGER DEFAULT 0,
     is_banned INTEGER DEFAULT 0,
-    ban_until TIMESTAMP,
-    restrict_until TIMESTAMP,
+    ban_until INTEGER,
+    restrict_until INTEGER,
     rules_accepted INTEGER DEFAULT 0
 );
 
@@ -127,7 +127,24 @@ CREATE TABLE IF NOT EXISTS logs (
 -- Индексы
 CREATE INDEX IF NOT EXISTS idx_orders_memo_order_id ON orders (memo_order_id);
 CREATE INDEX IF NOT EXISTS idx_order_escorts_order_id ON order_escorts (order_id);
+CREATE INDEX IF NOT EXISTS idx_order_escorts_escort_id ON order_escorts (escort_id);
 CREATE INDEX IF NOT EXISTS idx_order_applications_order_id ON order_applications (order_id);
 CREATE INDEX IF NOT EXISTS idx_payouts_order_id ON payouts (order_id);
 CREATE INDEX IF NOT EXISTS idx_action_log_action_date ON action_log (action_date);
 CREATE INDEX IF NOT EXISTS idx_escorts_telegram_id ON escorts (telegram_id);
+CREATE INDEX IF NOT EXISTS idx_orders_status_created_at ON orders (status, created_at);
+CREATE INDEX IF NOT EXISTS idx_payouts_escort_id_payout_date ON payouts (escort_id, payout_date);
+CREATE INDEX IF NOT EXISTS idx_escorts_squad_id ON escorts (squad_id);
+CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders (created_at);
+CREATE INDEX IF NOT EXISTS idx_orders_squad_id ON orders (squad_id);
+
+-- При расформировании сквада его участники остаются без сквада
+CREATE TRIGGER IF NOT EXISTS trg_squads_unlink_escorts
+AFTER DELETE ON squads
+BEGIN
+    UPDATE escorts SET squad_id = NULL WHERE squad_id = OLD.id;
+END;
+
+-- Миграция: сроки бана и ограничения хранятся в unix-времени (раньше — локальная ISO-строка)
+UPDATE escorts SET ban_until = CAST(strftime('%s', ban_until, 'utc') AS INTEGER) WHERE typeof(ban_until) = 'text';
+UPDATE escorts SET restrict_until = CAST(strftime('%s', restrict_until, 'utc') AS INTEGER) WHERE typeof(restrict_until) = 'text';